@@ -1,67 +1,183 @@
-import json
+import hmac
+import io
 import os
+import time
 from datetime import datetime
 from typing import Any, Dict
 import pandas as pd
-from flask import Flask, jsonify, request
-
-# slack
-from slack import WebClient
-from slack.errors import SlackApiError
+from flask import Flask, Request, jsonify, request, send_from_directory
 
 # database stuff
 from flask import jsonify
-from shapely.geometry import mapping
 from geoalchemy2.shape import to_shape
 
 from read_write_postings import (
     insert_posting,
+    insert_postings,
     Session,
     Postings,
     DeletedPosts,
-    process_uploaded_image,
+    parse_filter_args,
     load_filter_postings,
+    load_filter_postings_geojson,
+    load_postings_tile,
+    load_postings_clusters,
+    load_posting_changes,
+    decode_cursor,
+    tile_bounds,
+    postings_to_feature_collection,
+    crop_feature_collection,
+    crop_postings,
+)
+from comments import MAX_COMMENT_IDS, PATH_COMMENTS, CommentCache, insert_comment
+from database import load_db_login, pool_status
+from image_processing import (
+    IMAGE_SIZES,
+    MAX_UPLOAD_BYTES,
+    ImageJobs,
+    find_image,
+    image_files,
+    image_path,
+    link_image,
+    move_image,
+    process_uploaded_image,
+    read_upload,
+    variant_name,
+)
+from image_store import (
+    PATH_BLOBS,
+    add_post_image,
+    blob_path,
+    content_hash,
+    find_post_image,
+    release_post_images,
+    static_image_links,
 )
+from ip_blocklist import IPBlocklist
+from rate_limit import RateLimits
+from notifications import get_dispatcher, post_to_slack
+from postings_cache import DataVersion, PostingsCache, notify_posting_change, start_change_listener
+
+# reloaded automatically when blocked_ips.json changes, or via /admin/reload_blocklist
+BLOCKLIST = IPBlocklist()
+# per IP and per user_id limits of the write endpoints
+RATE_LIMITS = RateLimits()
+# token for the /admin endpoints, which are disabled if it is not set
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
 
-with open("blocked_ips.json", "r") as infile:
-    # NOTE: blocking an IP requires restart of app.py via waitress
-    blocked_ips = json.load(infile)
+PATH_IMAGES = os.path.join("..", "..", "images", "freestuff", "images")
+PATH_DELETED = os.path.join("..", "..", "images", "freestuff", "deleted")
+# serialize /postings.json in PostGIS (True) or from ORM objects with shapely (False)
+GEOJSON_FROM_DB = True
+# ETags change at least this often, since posts age out of the time filter without any write
+ETAG_TIME_BUCKET = 60  # seconds
 
-# dictionary with comment by IP address - used to block predatory ips
-with open("ip_comment_dict.json", "r") as f:
-    IP_COMMENT_DICT = json.load(f)
+MAX_PHOTOS = 10
+MAX_BATCH_POSTS = 100
+# fields of a posting that clients cannot set (see client_posting)
+IMPORTER_FIELDS = {"fingerprint", "geometry"}
 
 
-PATH_COMMENTS = os.path.join("..", "..", "images", "freestuff", "comments")
-PATH_IMAGES = os.path.join("..", "..", "images", "freestuff", "images")
-PATH_DELETED = os.path.join("..", "..", "images", "freestuff", "deleted")
-CLIENT = WebClient(token=os.environ["SLACK_TOKEN"])
+class InMemoryRequest(Request):
+    """Keeps uploaded files in memory instead of spooling them to temporary files."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
 
 app = Flask(__name__)
+app.request_class = InMemoryRequest
+# larger requests are rejected with 413 before the body is read
+app.config["MAX_CONTENT_LENGTH"] = MAX_PHOTOS * MAX_UPLOAD_BYTES + 1024 * 1024
+
+# cache for /postings.json, invalidated via Postgres notifications from all writers (app, crawler, cron scripts)
+POSTINGS_CACHE = PostingsCache()
+# uploads are resized in worker processes
+IMAGE_JOBS = ImageJobs()
+MAX_STATUS_WAIT = 30  # seconds
+
+# version of the posts table, used for ETags
+DATA_VERSION = DataVersion()
+# comments per post for /comments
+COMMENT_CACHE = CommentCache()
+start_change_listener(load_db_login(), [POSTINGS_CACHE, DATA_VERSION, COMMENT_CACHE])
+# Slack messages are sent from a background thread; created here so that a missing SLACK_TOKEN fails at startup
+get_dispatcher()
+
+
+def versioned_response(request_key: dict, load):
+    """
+    Answer with 304 Not Modified if the client's copy for `request_key` is still current,
+    otherwise with the response built by `load`. The ETag is derived from the data version and
+    the current time bucket (see ETAG_TIME_BUCKET).
+    """
+    time_bucket = int(time.time() // ETAG_TIME_BUCKET)
+    # the version must be read before loading, so that a concurrent write always changes the ETag
+    etag = DATA_VERSION.etag(tuple(sorted(request_key.items())), time_bucket)
+    if etag is not None and etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = load()
 
+    if etag is not None:
+        response.set_etag(etag)
+        # clients may keep their copy, but have to revalidate it
+        response.headers["Cache-Control"] = "no-cache"
+    return response
 
-def post_to_slack(message: str) -> None:
-    """Post message to Slack channel."""
-    try:
-        CLIENT.chat_postMessage(channel="#freestuff", text=message, username="PennyMe")
-    except SlackApiError as e:
-        assert e.response["ok"] is False
-        assert e.response["error"]
-        raise e
+
+def client_posting(data):
+    """
+    A posting as sent by a client, without the fields that only the importers may set. Otherwise
+    any client could claim the fingerprint of a future Telegram message and block its import.
+    """
+    if not isinstance(data, dict):
+        return data
+    return {key: value for key, value in data.items() if key not in IMPORTER_FIELDS}
+
+
+@app.before_request
+def apply_rate_limits():
+    """Answer with 429 if the client exceeds the rate limit of the endpoint (see rate_limit.RATE_LIMITS)."""
+    if request.endpoint not in RATE_LIMITS:
+        # no need to parse the form of e.g. /postings.json
+        return None
+    # throttled clients are turned away before their (possibly large multipart) body is parsed
+    retry_after = RATE_LIMITS.ip_retry_after(request.endpoint, request.remote_addr)
+    if retry_after == 0:
+        user_id = request.args.get("user_id") or request.form.get("user_id")
+        retry_after = RATE_LIMITS.retry_after(request.endpoint, request.remote_addr, user_id)
+    if retry_after > 0:
+        response = jsonify({"error": "Too many requests, please try again later"})
+        response.headers["Retry-After"] = str(retry_after)
+        return response, 429
 
 
 @app.route("/add_post", methods=["POST"])
 def create_posting():
     ip_address = request.remote_addr
-    if ip_address in blocked_ips:
+    if BLOCKLIST.is_blocked(ip_address):
         return jsonify({"error": "User IP address is blocked"}), 403
 
-    post_infos = request.form.to_dict()
-    nr_photos = len(request.files.getlist("photos"))
+    post_infos = client_posting(request.form.to_dict())
+
+    # read and validate the photos before anything is stored
+    img_files = request.files.getlist("photos")
+    if len(img_files) > MAX_PHOTOS:
+        return jsonify({"error": f"At most {MAX_PHOTOS} photos are allowed"}), 400
+    try:
+        images = [read_upload(f) for f in img_files]
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    nr_photos = len(images)
 
     # insert posting into database
     jsonify_result, error_code, new_post_id = insert_posting(post_infos, nr_photos=nr_photos)
 
+    if error_code == 409:
+        # duplicate of an imported posting, nothing was stored
+        return jsonify_result, error_code
+
     # Error case: send error to frontend and slack
     if error_code != 200:
         post_to_slack(f"Error adding post: {jsonify_result['error']}")
@@ -71,103 +187,212 @@ def create_posting():
     # if len(request.files) == 0:
     #     return jsonify({"error": "No image file found"}), 400
 
-    img_files = request.files.getlist("photos")
-    for idx, f in enumerate(img_files):
-        img_path = os.path.join(PATH_IMAGES, f"{new_post_id}_{idx}.jpg")
-        f.save(img_path)
-        process_uploaded_image(img_path)
+    # identical photos are stored once (see image_store) and linked to {post_id}_{idx}.jpg for older app versions
+    session = Session()
+    try:
+        # image idx -> (path of the full variant to create, further paths of the full variant)
+        img_paths = {}
+        stored = []
+        for idx, image_data in enumerate(images):
+            image_hash = content_hash(image_data)
+            if add_post_image(session, new_post_id, idx, image_hash):
+                img_paths[idx] = (blob_path(image_hash), static_image_links(new_post_id, idx))
+            else:
+                stored.append((image_hash, idx))
+        session.commit()
+        # the post references these images now, so they are not removed in between
+        for image_hash, idx in stored:
+            for link_path in static_image_links(new_post_id, idx):
+                link_image(blob_path(image_hash), link_path)
+    except Exception as e:
+        # keep the photos as files of the post
+        print("Error adding images to the image store:", e)
+        session.rollback()
+        img_paths = {
+            idx: (image_path(PATH_IMAGES, variant_name(f"{new_post_id}_{idx}")), []) for idx in range(nr_photos)
+        }
+    finally:
+        session.close()
+
+    image_jobs = []
+    for idx, (img_path, links) in img_paths.items():
+        image_name = f"{new_post_id}_{idx}"
+        if IMAGE_JOBS.submit(image_name, process_uploaded_image, images[idx], img_path, links):
+            image_jobs.append(image_name)
+        else:
+            # all workers busy for too long or the pool broke: process in this thread
+            process_uploaded_image(images[idx], img_path, links)
 
     # send message to slack
     post_to_slack(f"New post added: {post_infos}")
 
+    jsonify_result["image_jobs"] = image_jobs
     return jsonify_result, error_code
 
 
+@app.route("/add_posts", methods=["POST"])
+def create_postings():
+    """
+    Add many postings (without photos) at once. The body is a JSON array of postings with the form
+    fields of /add_post. Returns one result per posting, either {"id": ...} or {"error": ...}.
+    """
+    ip_address = request.remote_addr
+    if BLOCKLIST.is_blocked(ip_address):
+        return jsonify({"error": "User IP address is blocked"}), 403
+
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        return jsonify({"error": "Expected a JSON array of postings"}), 400
+    if len(items) > MAX_BATCH_POSTS:
+        return jsonify({"error": f"At most {MAX_BATCH_POSTS} postings per request"}), 400
+
+    try:
+        results = insert_postings([client_posting(item) for item in items])
+    except Exception as e:
+        post_to_slack(f"Error adding {len(items)} posts: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    nr_added = sum("id" in result for result in results)
+    post_to_slack(f"{nr_added} of {len(items)} posts added in batch from {ip_address}")
+    return jsonify({"results": results}), 200
+
+
+@app.route("/image_status/<int:post_id>", methods=["GET"])
+def image_status(post_id):
+    """Processing status of the images uploaded with a post. Pass ?wait=<seconds> to await completion."""
+    timeout = min(request.args.get("wait", type=float, default=0), MAX_STATUS_WAIT)
+    job_ids = IMAGE_JOBS.job_ids(f"{post_id}_")
+    return jsonify(IMAGE_JOBS.status(job_ids, timeout=timeout)), 200
+
+
+@app.route("/images/<int:post_id>/<int:idx>", methods=["GET"])
+def get_image(post_id, idx):
+    """Photo of a post in the requested size (?size=thumb|medium|full, defaults to full)."""
+    size = request.args.get("size", default="full")
+    if size not in IMAGE_SIZES:
+        return jsonify({"error": f"Unknown size {size}"}), 400
+    path = find_post_image(post_id, idx, size)
+    folder = PATH_BLOBS
+    if path is None:
+        # posts created before the image store have their own files
+        # images uploaded before the variants existed only have the full size
+        path = find_image(PATH_IMAGES, variant_name(f"{post_id}_{idx}", size)) or find_image(
+            PATH_IMAGES, variant_name(f"{post_id}_{idx}")
+        )
+        folder = PATH_IMAGES
+    if path is None:
+        return jsonify({"error": "Image not found"}), 404
+    return send_from_directory(folder, os.path.relpath(path, folder), max_age=7 * 24 * 60 * 60)
+
+
 @app.route("/postings.json", methods=["GET"])
 def get_all_postings():
-    postings = load_filter_postings(request.args)
-
-    features = []
-    for post in postings:
-        expire = post.expiration_date.strftime("%Y-%m-%d") if post.expiration_date else ""
-        geom = to_shape(post.geometry)
-        feature = {
-            "type": "Feature",
-            "geometry": mapping(geom),
-            "properties": {
-                "id": post.id,
-                "name": post.name,
-                "time_posted": post.time_posted.split(".")[0][:-3],
-                "expiration_date": expire,
-                "photo_id": post.photo_id,
-                "category": post.category,
-                "subcategory": post.subcategory,
-                "description": post.description,
-                "external_url": post.external_url,
-                "status": post.status,
-                "user_id": post.user_id,
-            },
-        }
-        features.append(feature)
+    try:
+        filters = parse_filter_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def load():
+        if GEOJSON_FROM_DB:
+            # PostGIS builds the FeatureCollection for the tile-snapped box, it is only parsed if it has to be cropped
+            body = POSTINGS_CACHE.get_or_load(filters, load_filter_postings_geojson, crop=crop_feature_collection)
+            return app.response_class(body, mimetype="application/json")
+        postings = POSTINGS_CACHE.get_or_load(filters, load_filter_postings, crop=crop_postings)
+        return jsonify(postings_to_feature_collection(postings))
+
+    return versioned_response(filters, load)
+
+
+@app.route("/tiles/<int:z>/<int:x>/<int:y>.mvt", methods=["GET"])
+def get_postings_tile(z, x, y):
+    """Postings of one map tile as Mapbox Vector Tile, with the same filter args as /postings.json."""
+    if not (0 <= z <= 22 and 0 <= x < 2**z and 0 <= y < 2**z):
+        return jsonify({"error": "Invalid tile coordinates"}), 400
+    try:
+        filters = parse_filter_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # cache under the tile bounds, so that the entry is invalidated by writes inside the tile
+    west, south, east, north = tile_bounds(z, x, y)
+    cache_filters = dict(filters, swlng=west, swlat=south, nelng=east, nelat=north, cursor=None, tile=(z, x, y))
+
+    def load():
+        tile = POSTINGS_CACHE.get_or_load(cache_filters, lambda _: load_postings_tile(z, x, y, filters))
+        return app.response_class(tile, mimetype="application/vnd.mapbox-vector-tile")
 
-    return jsonify({"type": "FeatureCollection", "features": features})
+    return versioned_response(cache_filters, load)
+
+
+@app.route("/postings/clusters", methods=["GET"])
+def get_postings_clusters():
+    """Clustered postings for zoomed-out viewports, with the same args as /postings.json plus the zoom level."""
+    zoom = request.args.get("zoom", type=int)
+    if zoom is None or not 0 <= zoom <= 22:
+        return jsonify({"error": "Missing or invalid zoom level"}), 400
+    try:
+        filters = parse_filter_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    filters["cursor"] = None
+
+    def load():
+        # aggregating over the tile-snapped bounding box keeps clusters stable while panning
+        clusters = POSTINGS_CACHE.get_or_load(
+            dict(filters, zoom=zoom),
+            lambda snapped: load_postings_clusters(snapped, zoom),
+            crop=lambda value, _: value,
+        )
+        return jsonify(clusters)
+
+    return versioned_response(dict(filters, zoom=zoom), load)
+
+
+@app.route("/postings/changes", methods=["GET"])
+def get_posting_changes():
+    """Postings added and IDs removed since the cursor `since` returned by the previous call."""
+    try:
+        since = decode_cursor(request.args.get("since"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(load_posting_changes(since))
 
 
 @app.route("/add_comment", methods=["GET"])
 def add_comment():
-    """Receives a comment and adds it to the json file."""
+    """Receives a comment and adds it to the comment store."""
 
     comment = str(request.args.get("comment"))
     post_id = str(request.args.get("id"))
 
     ip_address = request.remote_addr
-    if ip_address in blocked_ips:
+    if BLOCKLIST.is_blocked(ip_address):
         return jsonify({"error": "User IP address is blocked"}), 403
 
-    path_machine_comments = os.path.join(PATH_COMMENTS, f"{post_id}.json")
-    if os.path.exists(path_machine_comments):
-        with open(path_machine_comments, "r") as infile:
-            # take previous comments and add paragaph
-            all_comments = json.load(infile)
-    else:
-        all_comments = {}
-
-    all_comments[str(datetime.now())] = comment
-
-    with open(path_machine_comments, "w") as outfile:
-        json.dump(all_comments, outfile, indent=4)
-
-    # send message to slack
-    # message_slack(machine_id, comment, ip=ip_address)
+    if not post_id.isdigit():
+        return jsonify({"error": "Invalid post id"}), 400
 
-    save_comment(comment, ip_address, post_id)
+    # comments by IP address are used to block predatory IPs
+    insert_comment(int(post_id), comment, ip_address)
+    COMMENT_CACHE.invalidate(int(post_id))
 
     post_to_slack(f"New comment for post {post_id}: {comment}")
 
     return jsonify({"message": "Success!"}), 200
 
 
-def save_comment(comment: str, ip: str, machine_id: int):
-    """
-    Saves a comment to the json file.
-
-    Args:
-        comment: The comment to save.
-        ip: The IP address of the user.
-        machine_id: The ID of the machine.
-    """
-    # Create dict hierarchy if needed
-    if ip not in IP_COMMENT_DICT.keys():
-        IP_COMMENT_DICT[ip] = {}
-    if machine_id not in IP_COMMENT_DICT[ip].keys():
-        IP_COMMENT_DICT[ip][machine_id] = {}
-
-    # Add comment
-    IP_COMMENT_DICT[ip][machine_id][str(datetime.now())] = comment
+@app.route("/comments", methods=["GET"])
+def get_comments():
+    """Comments of several posts, e.g. /comments?ids=1,2,3 returns {"1": {time: comment}, "2": {}, ...}."""
+    try:
+        post_ids = list(dict.fromkeys(int(post_id) for post_id in request.args.get("ids", "").split(",") if post_id))
+    except ValueError:
+        return jsonify({"error": "ids must be a comma separated list of post ids"}), 400
+    if len(post_ids) > MAX_COMMENT_IDS:
+        return jsonify({"error": f"At most {MAX_COMMENT_IDS} ids per request"}), 400
 
-    # Resave the file
-    with open("ip_comment_dict.json", "w") as f:
-        json.dump(IP_COMMENT_DICT, f, indent=4)
+    all_comments = COMMENT_CACHE.get_many(post_ids)
+    return jsonify({str(post_id): all_comments[post_id] for post_id in post_ids})
 
 
 @app.route("/delete_post/<int:post_id>", methods=["DELETE"])
@@ -193,6 +418,8 @@ def delete_post(post_id):
             status=post.status,
             user_id=post.user_id,
             geometry=post.geometry,
+            fingerprint=post.fingerprint,
+            created_at=post.created_at,
             deleted_at=datetime.now(),
             deletion_mode=mode,
         )
@@ -200,21 +427,20 @@ def delete_post(post_id):
         # Add to deleted_posts and remove from postings
         session.add(deleted)
         session.delete(post)
+        location = to_shape(post.geometry)
+        notify_posting_change(session, "delete", post.id, location.x, location.y)
+        release_post_images(session, [post.id])
         session.commit()
 
         post_to_slack(f"Deleted post {post_id} ({mode})")
 
         # remove comment file
-        comment_fn = os.path.join(PATH_COMMENTS, f"{post_id}.json")
-        if os.path.exists(comment_fn):
-            os.rename(comment_fn, os.path.join(PATH_DELETED, f"{post_id}.json"))
+        COMMENT_CACHE.invalidate(post_id)
+        move_image(f"{post_id}.json", PATH_COMMENTS, PATH_DELETED)
 
-        # move images to deleted folder
-        if not "http" in post.photo_id and len(post.photo_id) > 0:
-            photo_ids = post.photo_id.split(",")
-            for photo_id in photo_ids:
-                photo_fn = f"{post_id}{photo_id}.jpg"
-                os.rename(os.path.join(PATH_IMAGES, photo_fn), os.path.join(PATH_DELETED, photo_fn))
+        # move images (all size variants) of posts created before the image store to deleted folder
+        for photo_fn in image_files(post_id, post.photo_id):
+            move_image(photo_fn, PATH_IMAGES, PATH_DELETED)
 
         return {"status": "success", "message": f"Post {post_id} deleted."}, 200
     except Exception as e:
@@ -225,9 +451,22 @@ def delete_post(post_id):
         session.close()
 
 
+@app.route("/admin/reload_blocklist", methods=["POST"])
+def reload_blocklist():
+    """Reload blocked_ips.json without waiting for the modification time check."""
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        return jsonify({"error": "Forbidden"}), 403
+    try:
+        nr_entries = BLOCKLIST.reload()
+    except (OSError, ValueError) as e:
+        return jsonify({"error": f"Could not reload blocklist: {e}"}), 500
+    return jsonify({"message": "Blocklist reloaded", "entries": nr_entries}), 200
+
+
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"message": "Health check okay"}), 200
+    return jsonify({"message": "Health check okay", "db_pool": pool_status()}), 200
 
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+"""
+Benchmark the two serialization modes of /postings.json:
+ORM objects + shapely + json (GEOJSON_FROM_DB = False) vs. PostGIS-built GeoJSON (GEOJSON_FROM_DB = True).
+
+Synthetic posts are inserted in an otherwise empty bounding box, inside a transaction that is rolled
+back afterwards: they are never visible to other clients and no change notifications are sent.
+Usage: python benchmark_postings.py
+"""
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import numpy as np
+from geoalchemy2.shape import from_shape
+from shapely.geometry import Point
+
+from database import get_engine
+from read_write_postings import (
+    Postings,
+    Session,
+    load_filter_postings,
+    load_filter_postings_geojson,
+    postings_to_feature_collection,
+)
+
+# somewhere in the Southern Ocean, no real posts there
+BENCHMARK_BBOX = {"swlng": 170.0, "swlat": -60.0, "nelng": 171.0, "nelat": -59.0}
+BENCHMARK_NAME = "__benchmark__"
+ROW_COUNTS = [150, 5000]
+REPETITIONS = 20
+
+
+@contextmanager
+def seeded_postings(nr_rows: int):
+    """
+    Seed `nr_rows` benchmark posts in a transaction that is rolled back on exit. All sessions of
+    read_write_postings join this transaction meanwhile, so the loaders see the posts, while
+    NOTIFY (only delivered on commit) and the rows themselves never leave it.
+    """
+    rng = np.random.default_rng(0)
+    connection = get_engine().connect()
+    transaction = connection.begin()
+    # commits of the joined sessions only release savepoints
+    Session.configure(bind=connection, join_transaction_mode="create_savepoint")
+    session = Session()
+    try:
+        now = datetime.now()
+        session.add_all(
+            [
+                Postings(
+                    name=BENCHMARK_NAME,
+                    time_posted=now - timedelta(minutes=i),
+                    expiration_date=(now + timedelta(days=3)).date(),
+                    photo_id="_0",
+                    category="Goods" if i % 2 else "Food",
+                    subcategory="",
+                    description="Benchmark posting " * 5,
+                    external_url=None,
+                    user_id="benchmark",
+                    status="temporary",
+                    geometry=from_shape(
+                        Point(
+                            rng.uniform(BENCHMARK_BBOX["swlng"], BENCHMARK_BBOX["nelng"]),
+                            rng.uniform(BENCHMARK_BBOX["swlat"], BENCHMARK_BBOX["nelat"]),
+                        ),
+                        srid=4326,
+                    ),
+                )
+                for i in range(nr_rows)
+            ]
+        )
+        session.commit()
+        yield
+    finally:
+        session.close()
+        Session.configure(bind=get_engine(), join_transaction_mode="conditional_savepoint")
+        transaction.rollback()
+        connection.close()
+
+
+def time_mode(serialize, repetitions: int = REPETITIONS) -> float:
+    """Return the median time in ms of one serialization."""
+    timings = []
+    for _ in range(repetitions):
+        tic = time.perf_counter()
+        serialize()
+        timings.append((time.perf_counter() - tic) * 1000)
+    return float(np.median(timings))
+
+
+def run_benchmark():
+    filters = {
+        **BENCHMARK_BBOX,
+        "show_goods": True,
+        "show_food": True,
+        "goods_subcategory": "All",
+        "food_subcategory": "All",
+        "time_posted_max_days": 20,
+        "show_permanent": True,
+        "cursor": None,
+    }
+    for nr_rows in ROW_COUNTS:
+        with seeded_postings(nr_rows):
+            orm_ms = time_mode(
+                lambda: json.dumps(postings_to_feature_collection(load_filter_postings(filters, nr_rows), nr_rows))
+            )
+            db_ms = time_mode(lambda: load_filter_postings_geojson(filters, nr_rows))
+        print(f"{nr_rows} rows: ORM + shapely {orm_ms:.1f} ms, PostGIS GeoJSON {db_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    run_benchmark()
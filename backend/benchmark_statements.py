@@ -0,0 +1,84 @@
+"""
+Microbenchmark of the per-request compile and plan overhead of the /postings.json query,
+with and without server-side prepared statements (USE_PREPARED_STATEMENTS).
+
+Usage: python benchmark_statements.py
+"""
+import json
+import time
+
+import numpy as np
+from sqlalchemy.dialects import postgresql
+
+import read_write_postings
+from database import PreparedQuery
+from read_write_postings import MAX_RESULTS, Session, filter_params, geojson_statement, load_filter_postings_geojson
+
+FILTERS = {
+    "nelat": 47.43,
+    "nelng": 8.63,
+    "swlat": 47.32,
+    "swlng": 8.45,
+    "show_goods": True,
+    "show_food": False,
+    "goods_subcategory": "All",
+    "food_subcategory": "All",
+    "time_posted_max_days": 20,
+    "show_permanent": True,
+    "cursor": None,
+}
+REPETITIONS = 200
+
+
+def median_ms(function, repetitions: int = REPETITIONS) -> float:
+    timings = []
+    for _ in range(repetitions):
+        tic = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - tic) * 1000)
+    return float(np.median(timings))
+
+
+def planning_time_ms(cursor, sql: str, params) -> float:
+    cursor.execute("EXPLAIN (SUMMARY, FORMAT JSON) " + sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Planning Time"]
+
+
+def run_benchmark():
+    session = Session()
+    try:
+        dialect = postgresql.dialect()
+        build_ms = median_ms(lambda: geojson_statement(session, FILTERS, MAX_RESULTS))
+        compile_ms = median_ms(lambda: geojson_statement(session, FILTERS, MAX_RESULTS).compile(dialect=dialect))
+        params_ms = median_ms(lambda: filter_params(FILTERS, MAX_RESULTS))
+        print(f"Python: build statement {build_ms:.3f} ms, build + compile {compile_ms:.3f} ms")
+        print(f"Python: prepared statement parameters only {params_ms:.3f} ms")
+
+        compiled = geojson_statement(session, FILTERS, MAX_RESULTS).compile(dialect=dialect)
+        prepared = PreparedQuery(geojson_statement(session, FILTERS, MAX_RESULTS))
+        # executing it a few times lets Postgres switch to a generic plan
+        for _ in range(10):
+            prepared.execute(session, filter_params(FILTERS, MAX_RESULTS)).fetchall()
+
+        cursor = session.connection().connection.cursor()
+        values = {**prepared.defaults, **filter_params(FILTERS, MAX_RESULTS)}
+        execute_sql = f"EXECUTE {prepared.name}({', '.join(['%s'] * len(prepared.param_names))})"
+        plain_plan = np.median([planning_time_ms(cursor, str(compiled), compiled.params) for _ in range(20)])
+        prepared_plan = np.median(
+            [planning_time_ms(cursor, execute_sql, [values[name] for name in prepared.param_names]) for _ in range(20)]
+        )
+        print(f"Postgres: planning {plain_plan:.3f} ms, prepared {prepared_plan:.3f} ms")
+    finally:
+        session.close()
+
+    for use_prepared in [False, True]:
+        read_write_postings.USE_PREPARED_STATEMENTS = use_prepared
+        total_ms = median_ms(lambda: load_filter_postings_geojson(FILTERS), 50)
+        print(f"End to end (prepared={use_prepared}): {total_ms:.3f} ms")
+
+
+if __name__ == "__main__":
+    run_benchmark()
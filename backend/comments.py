@@ -0,0 +1,201 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, String, Text
+
+from read_write_postings import Base, Postings, Session
+
+PATH_COMMENTS = os.path.join("..", "..", "images", "freestuff", "comments")
+# comments by IP address, written by older versions of the app (imported by migrate_schema.py)
+IP_COMMENT_FILE = "ip_comment_dict.json"
+# also keep {post_id}.json up to date for app versions that download it directly. This rewrites the file
+# from all comments of the post on every new comment, so disable it once those versions are gone.
+WRITE_COMMENT_FILES = True
+# maximum number of posts per call of /comments
+MAX_COMMENT_IDS = 100
+COMMENT_CACHE_MAX_POSTS = 4096
+COMMENT_CACHE_TTL = 10 * 60  # seconds
+
+# serializes the rewrites of {post_id}.json in this process
+_comment_file_lock = threading.Lock()
+
+
+class Comments(Base):
+    __tablename__ = "comments"
+
+    id = Column(Integer, primary_key=True)
+    post_id = Column(Integer, nullable=False)
+    ip = Column(String)
+    comment = Column(Text)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+def insert_comment(post_id: int, comment: str, ip: str) -> None:
+    """
+    Store a comment. This is a single INSERT, independent of the number of existing comments
+    (unless WRITE_COMMENT_FILES is set).
+    """
+    session = Session()
+    try:
+        session.add(Comments(post_id=post_id, ip=ip, comment=comment, created_at=datetime.now()))
+        session.commit()
+        if WRITE_COMMENT_FILES:
+            write_comment_file(session, post_id)
+    finally:
+        session.close()
+
+
+def load_comments(session, post_id: int) -> dict:
+    """Comments of a post in the format of {post_id}.json, i.e. {time: comment}."""
+    rows = (
+        session.query(Comments.created_at, Comments.comment)
+        .filter(Comments.post_id == post_id)
+        .order_by(Comments.created_at)
+    )
+    return {str(created_at): comment for created_at, comment in rows}
+
+
+def load_comments_for_posts(post_ids: list) -> dict:
+    """
+    Comments of several posts with one query, as {post_id: {time: comment}}. Deleted posts
+    have no comments, like their archived {post_id}.json.
+    """
+    all_comments = {post_id: {} for post_id in post_ids}
+    session = Session()
+    try:
+        rows = (
+            session.query(Comments.post_id, Comments.created_at, Comments.comment)
+            .join(Postings, Postings.id == Comments.post_id)
+            .filter(Comments.post_id.in_(post_ids))
+            .order_by(Comments.post_id, Comments.created_at)
+        )
+        for post_id, created_at, comment in rows:
+            all_comments[post_id][str(created_at)] = comment
+    finally:
+        session.close()
+    return all_comments
+
+
+def write_comment_file(session, post_id: int) -> None:
+    """Rewrite {post_id}.json from the table (only this post's comments), atomically."""
+    path = os.path.join(PATH_COMMENTS, f"{post_id}.json")
+    with _comment_file_lock:
+        all_comments = load_comments(session, post_id)
+        with open(path + ".tmp", "w") as outfile:
+            json.dump(all_comments, outfile, indent=4)
+        os.replace(path + ".tmp", path)
+
+
+def read_comment_files(path_comments: str = PATH_COMMENTS, ip_comment_file: str = IP_COMMENT_FILE) -> list:
+    """
+    Read the comments stored as JSON files into (post_id, ip, comment, created_at) rows.
+    The IP is taken from the IP file, whose entries were written right after the post files. Comments
+    that are only in the IP file (e.g. of deleted posts) are included as well.
+    """
+    by_ip = {}
+    if os.path.exists(ip_comment_file):
+        with open(ip_comment_file, "r") as infile:
+            for ip, posts in json.load(infile).items():
+                for post_id, post_comments in posts.items():
+                    # older versions stored whatever ID the request contained, e.g. "None"
+                    if not post_id.isdigit():
+                        continue
+                    for created_at, comment in post_comments.items():
+                        key = (int(post_id), comment)
+                        by_ip.setdefault(key, []).append((datetime.fromisoformat(created_at), ip))
+
+    rows = []
+    for file_name in sorted(os.listdir(path_comments)) if os.path.exists(path_comments) else []:
+        post_id, extension = os.path.splitext(file_name)
+        if extension != ".json" or not post_id.isdigit():
+            continue
+        with open(os.path.join(path_comments, file_name), "r") as infile:
+            post_comments = json.load(infile)
+        for created_at, comment in post_comments.items():
+            created_at = datetime.fromisoformat(created_at)
+            candidates = by_ip.get((int(post_id), comment), [])
+            # the closest entry, both were written within the same request
+            match = min(candidates, key=lambda c: abs((c[0] - created_at).total_seconds()), default=None)
+            if match is not None and abs((match[0] - created_at).total_seconds()) < 1:
+                candidates.remove(match)
+                ip = match[1]
+            else:
+                ip = None
+            rows.append((int(post_id), ip, comment, created_at))
+
+    for (post_id, comment), candidates in by_ip.items():
+        for created_at, ip in candidates:
+            rows.append((post_id, ip, comment, created_at))
+    return rows
+
+
+class CommentCache:
+    """
+    In-process LRU cache (with TTL) of the comments per post. Entries are invalidated by new comments
+    and evicted when a post is deleted, also by other processes via the posts change notifications.
+    """
+
+    def __init__(self, max_posts: int = COMMENT_CACHE_MAX_POSTS, ttl: float = COMMENT_CACHE_TTL):
+        self.max_posts = max_posts
+        self.ttl = ttl
+        # post ID -> (expiry time, comments)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped on every invalidation, so that comments loaded concurrently to a write are not stored
+        self._generation = 0
+
+    def get_many(self, post_ids: list, loader=load_comments_for_posts) -> dict:
+        """
+        Return the comments of the posts, loading all cache misses with one call of `loader`.
+
+        Args:
+            post_ids: IDs of the posts.
+            loader: Function that is called with the list of missing post IDs and returns
+                {post_id: comments} for them.
+        """
+        found, missing = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for post_id in post_ids:
+                entry = self._entries.get(post_id)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(post_id)
+                    found[post_id] = entry[1]
+                else:
+                    missing.append(post_id)
+            generation = self._generation
+        if not missing:
+            return found
+
+        loaded = loader(missing)
+
+        with self._lock:
+            if generation == self._generation:
+                expiry = time.monotonic() + self.ttl
+                for post_id, comments in loaded.items():
+                    self._entries[post_id] = (expiry, comments)
+                    self._entries.move_to_end(post_id)
+                while len(self._entries) > self.max_posts:
+                    self._entries.popitem(last=False)
+        found.update(loaded)
+        return found
+
+    def invalidate(self, post_id: int) -> None:
+        """Drop the comments of a post, e.g. after a new comment or its deletion."""
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(post_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def handle_change(self, change: dict) -> None:
+        """Apply a change notification on the posts table (see postings_cache.notify_posting_change)."""
+        if change["op"] == "delete":
+            self.invalidate(change["id"])
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import re
+import threading
+import time
+
+import psycopg2
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.types import NullType
+
+DB_FILE = "db_login.json"
+
+# pool defaults, sized for the waitress worker threads
+POOL_SIZE = 8
+MAX_OVERFLOW = 8
+POOL_TIMEOUT = 10  # seconds to wait for a free connection before failing
+POOL_RECYCLE = 30 * 60  # seconds after which connections are replaced
+STATEMENT_TIMEOUT = 15_000  # ms
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def load_db_login(db_file: str = DB_FILE) -> dict:
+    """Load the psycopg2 connection arguments."""
+    with open(db_file, "r") as infile:
+        return json.load(infile)
+
+
+class PoolMetrics:
+    """Counts checkouts and the time spent waiting for a free connection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, seconds: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "avg_wait_ms": 1000 * self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "max_wait_ms": 1000 * self.max_wait,
+            }
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        tic = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.metrics.record_wait(time.perf_counter() - tic)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+def get_engine(
+    db_file: str = DB_FILE,
+    pool_size: int = POOL_SIZE,
+    max_overflow: int = MAX_OVERFLOW,
+    pool_timeout: float = POOL_TIMEOUT,
+    pool_recycle: int = POOL_RECYCLE,
+    statement_timeout: int = STATEMENT_TIMEOUT,
+):
+    """
+    Return the engine for the database in `db_file`. Engines are created once per process and
+    shared by the app, the crawler and the maintenance scripts.
+
+    Args:
+        db_file: JSON file with the psycopg2 connection arguments.
+        pool_size: Number of connections kept open.
+        max_overflow: Additional connections opened under burst load.
+        pool_timeout: Seconds to wait for a connection if the pool is exhausted.
+        pool_recycle: Seconds after which a connection is replaced.
+        statement_timeout: Maximum duration of a statement in ms (0 disables the timeout).
+    """
+    with _engines_lock:
+        if db_file not in _engines:
+            db_login = load_db_login(db_file)
+
+            def get_con():
+                return psycopg2.connect(**db_login, options=f"-c statement_timeout={statement_timeout}")
+
+            _engines[db_file] = create_engine(
+                "postgresql+psycopg2://",
+                creator=get_con,
+                poolclass=MeteredQueuePool,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_timeout=pool_timeout,
+                pool_recycle=pool_recycle,
+                pool_pre_ping=True,
+            )
+        return _engines[db_file]
+
+
+def pool_status(db_file: str = DB_FILE) -> dict:
+    """Connection pool usage of the engine for `db_file`."""
+    pool = get_engine(db_file).pool
+    return {
+        "size": pool.size(),
+        "in_use": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": pool.overflow(),
+        **pool.metrics.as_dict(),
+    }
+
+
+class PreparedQuery:
+    """
+    Server-side prepared statement for one query shape. The SQLAlchemy statement is compiled
+    once, prepared once per pooled connection, and afterwards only executed with new values for
+    its named parameters, so neither SQLAlchemy nor Postgres have to compile or re-plan it.
+    """
+
+    def __init__(self, statement):
+        dialect = postgresql.dialect()
+        compiled = statement.compile(dialect=dialect)
+        # constant (anonymous) parameters keep the values they were compiled with
+        self.defaults = dict(compiled.params)
+        self.param_names = []
+
+        def to_positional(match):
+            name = match.group(1)
+            if name not in self.param_names:
+                self.param_names.append(name)
+            placeholder = f"${self.param_names.index(name) + 1}"
+            bind_type = compiled.binds[name].type
+            # parameter types cannot always be inferred when preparing, e.g. inside json_build_object
+            already_cast = match.string.startswith("::", match.end())
+            if already_cast or isinstance(bind_type, NullType):
+                return placeholder
+            return f"{placeholder}::{dialect.type_compiler_instance.process(bind_type)}"
+
+        self.sql = re.sub(r"%\(([^)]+)\)s", to_positional, str(compiled))
+        self.name = "stmt_" + hashlib.sha1(self.sql.encode()).hexdigest()[:16]
+
+    def execute(self, session, params: dict):
+        """
+        Execute the statement on the connection of `session` and return the DBAPI cursor.
+
+        Args:
+            session: The session whose connection is used (prepared statements are per connection).
+            params: Values for the named parameters of the statement.
+        """
+        connection = session.connection().connection
+        prepared = connection.info.setdefault("prepared_statements", set())
+        cursor = connection.cursor()
+        if self.name not in prepared:
+            cursor.execute(f"PREPARE {self.name} AS {self.sql}")
+            prepared.add(self.name)
+        values = {**self.defaults, **params}
+        placeholders = ", ".join(["%s"] * len(self.param_names))
+        cursor.execute(f"EXECUTE {self.name}({placeholders})", [values[name] for name in self.param_names])
+        return cursor
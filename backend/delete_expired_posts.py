@@ -1,78 +1,103 @@
 import os
-import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
-from shutil import move
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from geoalchemy2.shape import from_shape
-from shapely.geometry import Point
-from read_write_postings import Postings, DeletedPosts, Base, init_session
+
+from sqlalchemy import text
+
+from read_write_postings import Postings, Session
+from postings_cache import notify_posting_changes
+from image_processing import image_files, move_image
+from image_store import release_post_images
 
 # Constants
 PATH_COMMENTS = os.path.join("..", "..", "images", "freestuff", "comments")
 PATH_IMAGES = os.path.join("..", "..", "images", "freestuff", "images")
 PATH_DELETED = os.path.join("..", "..", "images", "freestuff", "deleted")
 DELETION_MODE = "expired"
+# posts archived per transaction, so that row locks are only held briefly
+CHUNK_SIZE = 500
+FILE_WORKERS = 8
 
-Session = init_session()
-
-
-def delete_expired_posts():
-    session = Session()
-    try:
-        today = date.today()
-        expired_posts = (
-            session.query(Postings).filter(Postings.status == "temporary", Postings.expiration_date < today).all()
-        )
+# all columns of posts are copied to deleted_posts
+ARCHIVED_COLUMNS = ", ".join(column.name for column in Postings.__table__.columns)
 
-        print(f"[{datetime.now()}] Found {len(expired_posts)} expired posts.")
+# Moves one chunk of expired posts to deleted_posts. Rows locked by a concurrent delete are skipped.
+ARCHIVE_EXPIRED = text(
+    f"""
+    WITH expired AS (
+        SELECT id FROM posts
+        WHERE status = 'temporary' AND expiration_date < :today
+        ORDER BY expiration_date, id
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    ), moved AS (
+        DELETE FROM posts USING expired WHERE posts.id = expired.id
+        RETURNING posts.*
+    )
+    INSERT INTO deleted_posts ({ARCHIVED_COLUMNS}, deleted_at, deletion_mode)
+    SELECT {ARCHIVED_COLUMNS}, :deleted_at, :deletion_mode FROM moved
+    RETURNING id, photo_id, ST_X(geometry) AS lon, ST_Y(geometry) AS lat
+    """
+)
 
-        for post in expired_posts:
-            print(f"Deleting expired post {post.id} with name {post.name}...")
-            # Move to DeletedPosts
-            deleted = DeletedPosts(
-                id=post.id,
-                name=post.name,
-                time_posted=post.time_posted,
-                expiration_date=post.expiration_date,
-                photo_id=post.photo_id,
-                category=post.category,
-                subcategory=post.subcategory,
-                description=post.description,
-                external_url=post.external_url,
-                status=post.status,
-                geometry=post.geometry,
-                deleted_at=datetime.now(),
-                deletion_mode=DELETION_MODE,
-            )
 
-            session.add(deleted)
-            session.delete(post)
+def move_post_files(post_id: int, photo_id: str) -> None:
+    """
+    Move the comment file and the images (all size variants) of a post to the deleted folder. Images
+    in the image store are only released (see image_store.release_post_images).
+    """
+    move_image(f"{post_id}.json", PATH_COMMENTS, PATH_DELETED)
+    for image_name in image_files(post_id, photo_id):
+        move_image(image_name, PATH_IMAGES, PATH_DELETED)
 
-            # Move associated comment file
-            comment_fn = os.path.join(PATH_COMMENTS, f"{post.id}.json")
-            if os.path.exists(comment_fn):
-                move(comment_fn, os.path.join(PATH_DELETED, f"{post.id}.json"))
 
-            # Move associated images
-            if post.photo_id and not "http" in post.photo_id:
-                for pid in post.photo_id.split(","):
-                    image_name = f"{post.id}{pid}.jpg"
-                    src_path = os.path.join(PATH_IMAGES, image_name)
-                    dst_path = os.path.join(PATH_DELETED, image_name)
-                    print("move image from", src_path, "to", dst_path)
-                    if os.path.exists(src_path):
-                        move(src_path, dst_path)
+def report_error(future) -> None:
+    if future.exception() is not None:
+        print(f"Error while moving files of expired post: {future.exception()}")
 
-            print(f"Deleted expired post {post.id}")
 
+def archive_expired_chunk(session, today: date, limit: int = CHUNK_SIZE) -> list:
+    """Archive up to `limit` expired posts in one transaction. Returns the archived rows."""
+    try:
+        moved = session.execute(
+            ARCHIVE_EXPIRED,
+            {"today": today, "limit": limit, "deleted_at": datetime.now(), "deletion_mode": DELETION_MODE},
+        ).all()
+        notify_posting_changes(
+            session, [{"op": "delete", "id": row.id, "lon": row.lon, "lat": row.lat} for row in moved]
+        )
+        release_post_images(session, [row.id for row in moved])
         session.commit()
+        return moved
+    except Exception:
+        session.rollback()
+        raise
+
 
+def delete_expired_posts() -> bool:
+    """Archive all expired posts. Returns False if archiving failed (errors are printed, not raised)."""
+    session = Session()
+    nr_archived = 0
+    success = True
+    try:
+        today = date.today()
+        with ThreadPoolExecutor(max_workers=FILE_WORKERS) as pool:
+            while True:
+                moved = archive_expired_chunk(session, today)
+                nr_archived += len(moved)
+                print(f"[{datetime.now()}] Archived {len(moved)} expired posts.")
+                # files are moved after the commit, while the next chunk is archived
+                for row in moved:
+                    pool.submit(move_post_files, row.id, row.photo_id).add_done_callback(report_error)
+                if len(moved) < CHUNK_SIZE:
+                    break
     except Exception as e:
         print(f"Error while deleting expired posts: {e}")
-        session.rollback()
+        success = False
     finally:
         session.close()
+    print(f"[{datetime.now()}] Deleted {nr_archived} expired posts.")
+    return success
 
 
 if __name__ == "__main__":
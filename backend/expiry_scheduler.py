@@ -0,0 +1,118 @@
+"""
+Resident replacement of the delete_expired_posts cron job: keeps a min-heap of the upcoming
+expirations and archives posts as soon as they expire. The heap is kept up to date from the
+change notifications of the posts table and rebuilt whenever the listener (re)connects.
+
+Usage: python expiry_scheduler.py
+"""
+import heapq
+import threading
+from datetime import date, datetime, time, timedelta
+
+from database import load_db_login
+from delete_expired_posts import delete_expired_posts
+from postings_cache import start_change_listener
+from read_write_postings import Postings, Session
+
+# upper bound on the sleep, so that the wake-up time follows clock adjustments
+MAX_SLEEP = 10 * 60  # seconds
+# delay before posts are archived again after a failed attempt
+RETRY_DELAY = 60  # seconds
+
+
+def expiry_time(expiration_date: date) -> datetime:
+    """Posts expire at the start of the day after their expiration date (see delete_expired_posts)."""
+    return datetime.combine(expiration_date + timedelta(days=1), time.min)
+
+
+class ExpiryScheduler:
+    """Min-heap of (expiry time, post ID). Entries of deleted posts are skipped lazily when popped."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._heap = []
+        # post ID -> expiry time, for the posts that are still scheduled
+        self._scheduled = {}
+
+    def schedule(self, post_id: int, expiration_date: date) -> None:
+        due = expiry_time(expiration_date)
+        with self._condition:
+            self._scheduled[post_id] = due
+            heapq.heappush(self._heap, (due, post_id))
+            if self._heap[0] == (due, post_id):
+                # new earliest expiry
+                self._condition.notify()
+
+    def reschedule(self, post_ids: list, due: datetime) -> None:
+        """Schedule posts that were already popped again, e.g. after archiving them failed."""
+        with self._condition:
+            for post_id in post_ids:
+                if post_id not in self._scheduled:
+                    self._scheduled[post_id] = due
+                    heapq.heappush(self._heap, (due, post_id))
+            self._condition.notify()
+
+    def unschedule(self, post_id: int) -> None:
+        with self._condition:
+            self._scheduled.pop(post_id, None)
+
+    def handle_change(self, change: dict) -> None:
+        """Apply a change notification sent by postings_cache.notify_posting_change."""
+        if change["op"] == "delete":
+            self.unschedule(change["id"])
+        elif change.get("expiration_date"):
+            self.schedule(change["id"], date.fromisoformat(change["expiration_date"]))
+
+    def clear(self) -> None:
+        """Rebuild the heap from the database, since changes may have been missed."""
+        session = Session()
+        try:
+            rows = session.query(Postings.id, Postings.expiration_date).filter(
+                Postings.status == "temporary", Postings.expiration_date.isnot(None)
+            )
+            scheduled = {post_id: expiry_time(expiration_date) for post_id, expiration_date in rows}
+        finally:
+            session.close()
+        with self._condition:
+            self._scheduled = scheduled
+            self._heap = [(due, post_id) for post_id, due in scheduled.items()]
+            heapq.heapify(self._heap)
+            self._condition.notify()
+        print(f"[{datetime.now()}] Scheduled {len(scheduled)} temporary posts.")
+
+    def _pop_due(self) -> list:
+        """Remove and return the IDs of the scheduled posts that are due."""
+        now = datetime.now()
+        due_ids = []
+        while self._heap and self._heap[0][0] <= now:
+            due, post_id = heapq.heappop(self._heap)
+            if self._scheduled.get(post_id) == due:
+                del self._scheduled[post_id]
+                due_ids.append(post_id)
+        return due_ids
+
+    def run(self) -> None:
+        """Block forever, archiving posts whenever the earliest scheduled expiry is reached."""
+        while True:
+            with self._condition:
+                due_ids = self._pop_due()
+                while not due_ids:
+                    # drop entries of deleted posts, so that they do not determine the wake-up time
+                    while self._heap and self._scheduled.get(self._heap[0][1]) != self._heap[0][0]:
+                        heapq.heappop(self._heap)
+                    timeout = MAX_SLEEP
+                    if self._heap:
+                        timeout = min(max((self._heap[0][0] - datetime.now()).total_seconds(), 0), MAX_SLEEP)
+                    self._condition.wait(timeout)
+                    due_ids = self._pop_due()
+            print(f"[{datetime.now()}] {len(due_ids)} posts expired.")
+            # archives everything that is expired by now, which also emits the delete notifications
+            if not delete_expired_posts():
+                # posts that were archived nevertheless are skipped by the next attempt
+                self.reschedule(due_ids, datetime.now() + timedelta(seconds=RETRY_DELAY))
+
+
+if __name__ == "__main__":
+    scheduler = ExpiryScheduler()
+    start_change_listener(load_db_login(), [scheduler])
+    scheduler.run()
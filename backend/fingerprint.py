@@ -0,0 +1,16 @@
+import hashlib
+import re
+
+# Fingerprints identify the source of a posting (stored in posts.fingerprint, unique), so that
+# re-running an import or backfill does not insert the same posting again.
+
+
+def telegram_fingerprint(chat_id: int, msg_id: int) -> str:
+    return f"telegram:{chat_id}:{msg_id}"
+
+
+def content_fingerprint(text: str, time_posted, source: str = "content") -> str:
+    """Hash of the normalized text (case and whitespace insensitive) and the posting time."""
+    normalized = re.sub(r"\s+", " ", (text or "").strip().lower())
+    digest = hashlib.sha1(f"{normalized}|{time_posted}".encode()).hexdigest()
+    return f"{source}:{digest}"
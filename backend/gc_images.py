@@ -0,0 +1,151 @@
+"""
+Find image files that do not belong to any post (orphans) and posts whose images are missing.
+Orphans are moved to the deleted folder (or deleted with --delete). Images in the image store
+that are no longer used by any post are removed as well, after claiming them in the database
+(see image_store.claim_unused_blobs).
+
+Usage:
+    python gc_images.py --dry-run   # only report
+    python gc_images.py             # move orphans to the deleted folder
+    python gc_images.py --delete    # delete orphans
+"""
+import argparse
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from image_processing import image_files, image_path, scan_image_folder
+from image_store import (
+    PATH_BLOBS,
+    blob_hash,
+    blob_path,
+    claim_unused_blobs,
+    load_post_image_hashes,
+    stored_blob_hashes,
+)
+from read_write_postings import Postings, Session
+
+PATH_IMAGES = os.path.join("..", "..", "images", "freestuff", "images")
+PATH_DELETED = os.path.join("..", "..", "images", "freestuff", "deleted")
+# files younger than this are never orphans, they may belong to a post that is being created.
+# Files of the image store are protected by claiming them instead.
+GRACE_PERIOD = 60 * 60  # seconds
+BATCH_SIZE = 500
+WORKERS = 8
+
+
+def load_photo_ids(session) -> list:
+    """(post ID, photo_id) of all posts, with one query."""
+    return session.query(Postings.id, Postings.photo_id).all()
+
+
+def expected_images(photo_ids: list) -> set:
+    """All image files (all size variants) that the posts refer to."""
+    return {file_name for post_id, photo_id in photo_ids for file_name in image_files(post_id, photo_id)}
+
+
+def posts_with_missing_images(photo_ids: list, files: set, post_image_hashes: dict, blob_files: set) -> dict:
+    """
+    Posts whose full size images are missing, as {post_id: [missing files]}. Missing thumb or
+    medium variants are not reported, images uploaded before they existed have none.
+    """
+    missing = {}
+    for post_id, photo_id in photo_ids:
+        if post_id in post_image_hashes:
+            full_images = [os.path.basename(blob_path(image_hash)) for image_hash in post_image_hashes[post_id]]
+            absent = [file_name for file_name in full_images if file_name not in blob_files]
+        else:
+            full_images = image_files(post_id, photo_id, sizes=["full"])
+            absent = [file_name for file_name in full_images if file_name not in files]
+        if absent:
+            missing[post_id] = absent
+    return missing
+
+
+def remove_batch(entries: list, delete: bool) -> int:
+    """Delete the files or move them to the deleted folder, returns the number of files removed."""
+    nr_removed = 0
+    for entry in entries:
+        try:
+            if delete:
+                os.remove(entry.path)
+            else:
+                dst_path = image_path(PATH_DELETED, entry.name)
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                shutil.move(entry.path, dst_path)
+            nr_removed += 1
+        except FileNotFoundError:
+            # removed concurrently, e.g. by delete_post
+            pass
+    return nr_removed
+
+
+def unused_blobs(files: dict, used_hashes: set) -> dict:
+    """
+    Files of the image store whose images were not used by any post when used_hashes was loaded
+    (see image_store.release_post_images), as {hash: [files]}.
+    """
+    unused = {}
+    for name in sorted(files):
+        if blob_hash(name) not in used_hashes:
+            unused.setdefault(blob_hash(name), []).append(files[name])
+    return unused
+
+
+def remove_blobs(unused: dict, hashes: list, delete: bool) -> int:
+    """Claim the images and remove the files of those that are still unused, returns the number of files removed."""
+    session = Session()
+    try:
+        claimed = claim_unused_blobs(session, hashes)
+        # the claimed rows stay locked until the commit, i.e. until the files are gone
+        nr_removed = remove_batch([entry for image_hash in claimed for entry in unused[image_hash]], delete)
+        session.commit()
+        return nr_removed
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def collect_garbage(dry_run: bool = False, delete: bool = False) -> None:
+    # scan before querying, so that images of posts created in between are not mistaken for orphans
+    files = scan_image_folder(PATH_IMAGES)
+    blob_files = scan_image_folder(PATH_BLOBS) if os.path.exists(PATH_BLOBS) else {}
+    session = Session()
+    try:
+        photo_ids = load_photo_ids(session)
+        used_hashes = stored_blob_hashes(session)
+        post_image_hashes = load_post_image_hashes(session)
+    finally:
+        session.close()
+
+    expected = expected_images(photo_ids)
+    cutoff = time.time() - GRACE_PERIOD
+    orphans = [files[name] for name in sorted(files.keys() - expected) if files[name].stat().st_mtime < cutoff]
+    blobs = unused_blobs(blob_files, used_hashes)
+    missing = posts_with_missing_images(photo_ids, files.keys(), post_image_hashes, blob_files.keys())
+    print(f"{len(files)} image files, {len(expected)} referenced by posts")
+    print(f"{len(orphans)} orphaned files, {len(blobs)} unused images in the image store")
+    print(f"{len(missing)} posts with missing images: {sorted(missing)}")
+    if dry_run:
+        for entry in orphans + [entry for entries in blobs.values() for entry in entries]:
+            print("orphan:", entry.path)
+        return
+
+    batches = [orphans[i : i + BATCH_SIZE] for i in range(0, len(orphans), BATCH_SIZE)]
+    hashes = sorted(blobs)
+    blob_batches = [hashes[i : i + BATCH_SIZE] for i in range(0, len(hashes), BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        nr_removed = sum(pool.map(lambda batch: remove_batch(batch, delete), batches))
+        nr_removed += sum(pool.map(lambda batch: remove_blobs(blobs, batch, delete), blob_batches))
+    print(f"{'Deleted' if delete else 'Moved'} {nr_removed} orphaned files")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true", help="only report, do not touch any file")
+    parser.add_argument("--delete", action="store_true", help="delete orphans instead of moving them")
+    args = parser.parse_args()
+    collect_garbage(dry_run=args.dry_run, delete=args.delete)
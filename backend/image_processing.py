@@ -0,0 +1,290 @@
+import io
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageOps
+
+IMAGE_WORKERS = 2
+# uploads waiting for a worker; beyond that /add_post waits up to SUBMIT_TIMEOUT for a free slot
+MAX_PENDING_JOBS = 32
+SUBMIT_TIMEOUT = 10  # seconds
+JOB_STATUS_TTL = 60 * 60  # seconds that the status of finished jobs is kept
+
+# size variant -> width in px. The full variant used to be 400px wide.
+IMAGE_SIZES = {"thumb": 200, "medium": 600, "full": 1000}
+# format of the thumb and medium variants (JPEG or WEBP), full images stay JPEG for older app versions
+VARIANT_FORMAT = "JPEG"
+FILE_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp"}
+JPEG_QUALITY = 95
+# uploads larger than this are rejected before decoding
+MAX_UPLOAD_BYTES = 15 * 1024 * 1024
+MAX_UPLOAD_PIXELS = 50_000_000
+# images are stored in subfolders {post_id % NR_SHARDS:02x}, see image_path
+NR_SHARDS = 256
+# Shipped app versions load images from their static URL {PATH_IMAGES}/{post_id}_{idx}.jpg, so new files
+# stay in the flat layout (and migrate_images.py refuses to run) until no version in use does that anymore,
+# i.e. all of them load images through /images/<post_id>/<idx>.
+SHARD_IMAGES = False
+
+
+def variant_name(image_name: str, size: str = "full") -> str:
+    """
+    File name of one size variant of an image.
+
+    Args:
+        image_name: Name of the image without extension, i.e. {post_id}_{idx}.
+        size: One of IMAGE_SIZES. The full variant keeps the original name.
+    """
+    if size == "full":
+        return f"{image_name}.jpg"
+    return f"{image_name}_{size}.{FILE_EXTENSIONS[VARIANT_FORMAT]}"
+
+
+def image_files(post_id: int, photo_id: str, sizes=IMAGE_SIZES) -> list:
+    """Names of all files (of the given size variants, by default all) belonging to the photos of a post."""
+    if not photo_id or "http" in photo_id:
+        return []
+    return [variant_name(f"{post_id}{pid}", size) for pid in photo_id.split(",") for size in sizes]
+
+
+def shard_name(file_name: str) -> str:
+    """Subfolder of an image (or other file) named {post_id}_... or {post_id}.json."""
+    prefix = file_name.split("_")[0].split(".")[0]
+    if not prefix.isdigit():
+        return "other"
+    return f"{int(prefix) % NR_SHARDS:02x}"
+
+
+def image_path(folder: str, file_name: str, sharded: bool = None) -> str:
+    """
+    Path at which a file is stored in `folder`: {folder}/{shard}/{file_name} in the sharded layout,
+    {folder}/{file_name} in the flat one. Defaults to the layout selected by SHARD_IMAGES.
+    """
+    if sharded is None:
+        sharded = SHARD_IMAGES
+    if not sharded:
+        return os.path.join(folder, file_name)
+    return os.path.join(folder, shard_name(file_name), file_name)
+
+
+def find_image(folder: str, file_name: str):
+    """Path of an existing file in `folder` (in either layout), or None."""
+    for path in [image_path(folder, file_name, sharded=True), image_path(folder, file_name, sharded=False)]:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def move_image(file_name: str, src_folder: str, dst_folder: str) -> bool:
+    """Move a file (from either layout) to dst_folder (see image_path). Returns False if it does not exist."""
+    src_path = find_image(src_folder, file_name)
+    if src_path is None:
+        return False
+    dst_path = image_path(dst_folder, file_name)
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    shutil.move(src_path, dst_path)
+    return True
+
+
+def scan_image_folder(folder: str) -> dict:
+    """All files of `folder` in both layouts, as {file name: os.DirEntry}, streamed with os.scandir."""
+    files = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                with os.scandir(entry.path) as shard_entries:
+                    files.update((e.name, e) for e in shard_entries if e.is_file())
+            elif entry.is_file():
+                files[entry.name] = entry
+    return files
+
+
+def temp_path(path: str) -> str:
+    """
+    Unique hidden file name next to path, so that concurrent writers of the same path never share
+    a temporary file (and e.g. migrate_images skips it).
+    """
+    folder, file_name = os.path.split(path)
+    return os.path.join(folder, f".{file_name}.{uuid.uuid4().hex}.tmp")
+
+
+def save_atomic(img, path: str, image_format: str) -> None:
+    """Save so that readers see either the previous or the complete new file."""
+    tmp_path = temp_path(path)
+    try:
+        if image_format == "JPEG":
+            img.save(tmp_path, format="JPEG", quality=JPEG_QUALITY, progressive=True, optimize=True)
+        else:
+            img.save(tmp_path, format=image_format, quality=JPEG_QUALITY)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_upload(file_storage) -> bytes:
+    """
+    Read an uploaded image into memory. Raises ValueError for oversized files or images, which
+    is checked before anything is decoded.
+    """
+    image_data = file_storage.stream.read(MAX_UPLOAD_BYTES + 1)
+    if len(image_data) > MAX_UPLOAD_BYTES:
+        raise ValueError(f"Image is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+    try:
+        # only parses the header
+        width, height = Image.open(io.BytesIO(image_data)).size
+    except Exception:
+        raise ValueError("Uploaded file is not an image")
+    if width * height > MAX_UPLOAD_PIXELS:
+        raise ValueError(f"Image has more than {MAX_UPLOAD_PIXELS} pixels")
+    return image_data
+
+
+def open_reduced(image_data: bytes, basewidth: int):
+    """
+    Decode an image, letting JPEGs decode at a reduced scale (1/2, 1/4 or 1/8) as long as
+    the result is still at least `basewidth` wide after applying the EXIF orientation.
+    """
+    img = Image.open(io.BytesIO(image_data))
+    width, height = img.size
+    # orientations 5-8 swap width and height
+    if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+        requested = (width * basewidth // height, basewidth)
+    else:
+        requested = (basewidth, height * basewidth // width)
+    if requested[0] < width:
+        img.draft("RGB", requested)
+    return ImageOps.exif_transpose(img).convert("RGB")
+
+
+def link_image(src_path: str, dst_path: str) -> None:
+    """Make a file also available at dst_path, as hard link (without using space) or as copy."""
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    tmp_path = temp_path(dst_path)
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        # e.g. another file system
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+
+def process_uploaded_image(image_data: bytes, img_path: str, links: list = ()):
+    """
+    Optimizes an image for size/quality and saves all size variants (see IMAGE_SIZES). Each file
+    is written once, the original upload never touches the disk.
+
+    Args:
+        image_data: The encoded image as uploaded.
+        img_path: Path of the full variant, named {post_id}_{idx}.jpg (see image_path) or
+            {hash}.jpg (see image_store.blob_path). The others are saved next to it.
+        links: Further paths at which the full variant is made available (see link_image).
+    """
+    img = open_reduced(image_data, max(IMAGE_SIZES.values()))
+    folder, file_name = os.path.split(img_path)
+    os.makedirs(folder, exist_ok=True)
+    image_name = os.path.splitext(file_name)[0]
+
+    # largest first, so that each variant is resized from the next larger one
+    for size, basewidth in sorted(IMAGE_SIZES.items(), key=lambda item: -item[1]):
+        wpercent = basewidth / float(img.size[0])
+        if wpercent < 1:
+            hsize = int((float(img.size[1]) * float(wpercent)))
+            img = img.resize((basewidth, hsize), Image.Resampling.LANCZOS)
+        image_format = "JPEG" if size == "full" else VARIANT_FORMAT
+        save_atomic(img, os.path.join(folder, variant_name(image_name, size)), image_format)
+    for link_path in links:
+        link_image(img_path, link_path)
+
+
+class ImageJobs:
+    """
+    Bounded process pool for image processing, so that uploads do not hold a request thread.
+    Jobs are identified by the image name ({post_id}_{idx}) and their status can be queried or awaited.
+    """
+
+    def __init__(self, max_workers: int = IMAGE_WORKERS, max_pending: int = MAX_PENDING_JOBS):
+        self._max_workers = max_workers
+        self._executor = self._new_executor()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        # job ID -> (future, finish time)
+        self._jobs = {}
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawn instead of fork, the app process is multi-threaded
+        return ProcessPoolExecutor(max_workers=self._max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, job_id: str, function, *args) -> bool:
+        """
+        Run function(*args) in a worker process. Returns False if the queue stays full or the
+        pool is broken, then the caller has to run the function itself.
+        """
+        if not self._slots.acquire(timeout=SUBMIT_TIMEOUT):
+            return False
+        executor = self._executor
+        try:
+            future = executor.submit(function, *args)
+        except BrokenProcessPool:
+            # a worker died (e.g. out of memory on a huge photo), which breaks the whole pool
+            self._slots.release()
+            with self._lock:
+                if self._executor is executor:
+                    print("Image worker pool is broken, starting a new one")
+                    self._executor = self._new_executor()
+            executor.shutdown(wait=False)
+            return False
+        with self._lock:
+            self._forget_finished()
+            self._jobs[job_id] = (future, None)
+        future.add_done_callback(lambda _: self._finish(job_id))
+        return True
+
+    def _finish(self, job_id: str) -> None:
+        self._slots.release()
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id] = (self._jobs[job_id][0], time.monotonic())
+
+    def _forget_finished(self) -> None:
+        now = time.monotonic()
+        expired = [
+            job_id for job_id, (_, finished) in self._jobs.items() if finished and now - finished > JOB_STATUS_TTL
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def job_ids(self, prefix: str) -> list:
+        """IDs of the known jobs starting with prefix."""
+        with self._lock:
+            return sorted(job_id for job_id in self._jobs if job_id.startswith(prefix))
+
+    def status(self, job_ids: list, timeout: float = 0) -> dict:
+        """
+        Return "pending", "done", "failed: <error>" or "unknown" for each job, after waiting up to
+        `timeout` seconds for the pending ones.
+        """
+        with self._lock:
+            futures = {job_id: self._jobs[job_id][0] for job_id in job_ids if job_id in self._jobs}
+        if timeout > 0:
+            wait(futures.values(), timeout=timeout)
+
+        statuses = {}
+        for job_id in job_ids:
+            future = futures.get(job_id)
+            if future is None:
+                statuses[job_id] = "unknown"
+            elif not future.done():
+                statuses[job_id] = "pending"
+            elif future.exception() is not None:
+                statuses[job_id] = f"failed: {future.exception()}"
+            else:
+                statuses[job_id] = "done"
+        return statuses
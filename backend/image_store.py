@@ -0,0 +1,174 @@
+import hashlib
+import os
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, String, literal_column, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from image_processing import image_path, variant_name
+from read_write_postings import Base, Session
+
+# images are stored once per content hash, as {PATH_BLOBS}/{hash[:2]}/{hash}[_size].jpg
+PATH_BLOBS = os.path.join("..", "..", "images", "freestuff", "blobs")
+PATH_IMAGES = os.path.join("..", "..", "images", "freestuff", "images")
+# also hard-link the full variant to {PATH_IMAGES}/{post_id}_{idx}.jpg for app versions that load it directly
+WRITE_STATIC_IMAGES = True
+
+
+class ImageBlobs(Base):
+    """Stored images, with the number of (not deleted) posts that use them."""
+
+    __tablename__ = "image_blobs"
+
+    hash = Column(String, primary_key=True)
+    ref_count = Column(Integer, nullable=False)
+    created_at = Column(DateTime)
+
+
+class PostImages(Base):
+    """Image `idx` of a post. Posts created before the image store have none and use per-post files."""
+
+    __tablename__ = "post_images"
+
+    post_id = Column(Integer, primary_key=True)
+    idx = Column(Integer, primary_key=True)
+    hash = Column(String, nullable=False)
+
+
+class TelegramMedia(Base):
+    """Content hash of every Telegram photo that was downloaded, so that it is not downloaded again."""
+
+    __tablename__ = "telegram_media"
+
+    media_id = Column(String, primary_key=True)
+    hash = Column(String, nullable=False)
+
+
+def content_hash(image_data: bytes) -> str:
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def blob_path(image_hash: str, size: str = "full") -> str:
+    return os.path.join(PATH_BLOBS, image_hash[:2], variant_name(image_hash, size))
+
+
+def static_image_links(post_id: int, idx: int) -> list:
+    """Paths at which image `idx` of a post has to be available besides the image store."""
+    if not WRITE_STATIC_IMAGES:
+        return []
+    return [image_path(PATH_IMAGES, variant_name(f"{post_id}_{idx}"))]
+
+
+def add_post_image(session, post_id: int, idx: int, image_hash: str) -> bool:
+    """
+    Reference a stored image from a post (in the transaction of `session`). While the reference is
+    held, gc_images.py cannot remove the image (see claim_unused_blobs).
+
+    Returns:
+        True if the image is new, i.e. its variants have to be created at blob_path. This is also
+        the case if its files are missing, e.g. because processing failed; creating the variants
+        again is harmless (atomic writes).
+    """
+    session.execute(pg_insert(PostImages).values(post_id=post_id, idx=idx, hash=image_hash))
+    # xmax is 0 for a newly inserted row and set for a row that was updated instead
+    inserted = session.execute(
+        pg_insert(ImageBlobs)
+        .values(hash=image_hash, ref_count=1, created_at=datetime.now())
+        .on_conflict_do_update(index_elements=["hash"], set_={"ref_count": ImageBlobs.ref_count + 1})
+        .returning(literal_column("xmax = 0"))
+    ).scalar()
+    return inserted or not os.path.exists(blob_path(image_hash))
+
+
+def release_post_images(session, post_ids: list) -> None:
+    """Drop the images of deleted posts (in the transaction of `session`). Files are removed by gc_images.py."""
+    if not post_ids:
+        return
+    session.execute(
+        text(
+            """
+            WITH released AS (
+                DELETE FROM post_images WHERE post_id = ANY(:post_ids) RETURNING hash
+            )
+            UPDATE image_blobs SET ref_count = image_blobs.ref_count - refs.nr_refs
+            FROM (SELECT hash, count(*) AS nr_refs FROM released GROUP BY hash) AS refs
+            WHERE image_blobs.hash = refs.hash
+            """
+        ),
+        {"post_ids": list(post_ids)},
+    )
+
+
+def claim_unused_blobs(session, hashes: list) -> list:
+    """
+    Claim the images that are not used by any post for removal, in the transaction of `session`.
+    Their rows are deleted and stay locked until the transaction ends, so that add_post_image waits
+    for it and then stores the image again. The files must therefore be removed before committing.
+
+    Returns:
+        The claimed hashes. Images that were referenced again in the meantime are not claimed.
+    """
+    if not hashes:
+        return []
+    # files without a row (e.g. of a rolled back import) get one, so that a concurrent insert is waited for
+    session.execute(
+        pg_insert(ImageBlobs)
+        .values([{"hash": image_hash, "ref_count": 0, "created_at": datetime.now()} for image_hash in hashes])
+        .on_conflict_do_nothing()
+    )
+    return list(
+        session.execute(
+            text("DELETE FROM image_blobs WHERE hash = ANY(:hashes) AND ref_count <= 0 RETURNING hash"),
+            {"hashes": list(hashes)},
+        ).scalars()
+    )
+
+
+def find_post_image(post_id: int, idx: int, size: str = "full"):
+    """
+    Path of an image of a post in the requested size, falling back to the full size for images
+    stored before the size variants existed. None if the post has no image `idx` in the store.
+    """
+    session = Session()
+    try:
+        image_hash = session.query(PostImages.hash).filter_by(post_id=post_id, idx=idx).scalar()
+    finally:
+        session.close()
+    if image_hash is None:
+        return None
+    for path in [blob_path(image_hash, size), blob_path(image_hash)]:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def lookup_telegram_media(session, media_id: str):
+    """Hash of a Telegram photo that was downloaded before, if its image is still stored."""
+    image_hash = session.query(TelegramMedia.hash).filter_by(media_id=media_id).scalar()
+    if image_hash is not None and os.path.exists(blob_path(image_hash)):
+        return image_hash
+    return None
+
+
+def remember_telegram_media(session, media_id: str, image_hash: str) -> None:
+    session.execute(pg_insert(TelegramMedia).values(media_id=media_id, hash=image_hash).on_conflict_do_nothing())
+
+
+def stored_blob_hashes(session) -> set:
+    """Hashes of the stored images that are still used by a post."""
+    return {row[0] for row in session.query(ImageBlobs.hash).filter(ImageBlobs.ref_count > 0)}
+
+
+def load_post_image_hashes(session) -> dict:
+    """Hashes of the images of all posts in the image store, as {post_id: [hash of image 0, ...]}."""
+    hashes = {}
+    for post_id, image_hash in session.query(PostImages.post_id, PostImages.hash).order_by(
+        PostImages.post_id, PostImages.idx
+    ):
+        hashes.setdefault(post_id, []).append(image_hash)
+    return hashes
+
+
+def blob_hash(file_name: str) -> str:
+    """Content hash of a blob file, named {hash}.jpg or {hash}_{size}.{ext}."""
+    return file_name.split(".")[0].split("_")[0]
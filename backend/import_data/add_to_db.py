@@ -1,26 +1,24 @@
 import os
+import sys
 import json
 from shapely.geometry import shape
 from sqlalchemy.orm import sessionmaker
 from geoalchemy2.shape import from_shape
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, create_engine, DateTime
-import psycopg2
+from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy.dialects.postgresql import insert
 from geoalchemy2 import Geometry
 from sqlalchemy.ext.declarative import declarative_base
 
+# the shared engine factory lives in the backend root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from database import get_engine
+from fingerprint import content_fingerprint
+
 
 def init_session():
     """Initialize a database session."""
-    DB_FILE = os.path.join("..", "db_login.json")
-    with open(DB_FILE, "r") as infile:
-        db_login = json.load(infile)
-
-    def get_con():
-        return psycopg2.connect(**db_login)
-
-    engine = create_engine("postgresql+psycopg2://", creator=get_con)
-    return sessionmaker(bind=engine)
+    return sessionmaker(bind=get_engine(os.path.join("..", "db_login.json")))
 
 
 Base = declarative_base()
@@ -38,6 +36,7 @@ class Postings(Base):
     external_url = Column(String)
     status = Column(String)
     geometry = Column(Geometry(geometry_type="POINT", srid=4326))
+    fingerprint = Column(String)
 
 
 def import_geojson(path):
@@ -47,6 +46,7 @@ def import_geojson(path):
 
     Session = init_session()
     session = Session()
+    nr_inserted = 0
 
     for feature in data["features"]:
         geometry = shape(feature["geometry"])
@@ -55,7 +55,8 @@ def import_geojson(path):
         # Convert to WKT for PostGIS
         geo = from_shape(geometry, srid=4326)
 
-        post = Postings(
+        # features that were imported before are skipped (unique index on fingerprint)
+        post = dict(
             name=props.get("name", "Unnamed"),
             time_posted=props["time_posted"],  # adjust if needed
             photo_id=props.get("photo_id"),
@@ -64,14 +65,19 @@ def import_geojson(path):
             external_url=props.get("external_url"),
             status=props.get("status", "active"),
             geometry=geo,
+            fingerprint=content_fingerprint(
+                f"{props.get('name', '')} {props.get('description', '')}", props["time_posted"], source="geojson"
+            ),
         )
-
-        session.add(post)
+        result = session.execute(
+            insert(Postings).values(**post).on_conflict_do_nothing(index_elements=["fingerprint"])
+        )
+        nr_inserted += result.rowcount
 
     session.commit()
     session.close()
 
-    print("Import completed.")
+    print(f"Import completed, {nr_inserted} of {len(data['features'])} features were new.")
 
 
 if __name__ == "__main__":
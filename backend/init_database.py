@@ -1,23 +1,11 @@
-import json
-
 import pandas as pd
 import geopandas as gpd
 
-import psycopg2
-from sqlalchemy import create_engine
-
-DB_FILE = "db_login.json"
-with open(DB_FILE, "r") as infile:
-    db_login = json.load(infile)
-
-
-def get_con():
-    return psycopg2.connect(**db_login)
-
+from database import get_engine
 
-engine = create_engine("postgresql+psycopg2://", creator=get_con)
+engine = get_engine()
 
-from sqlalchemy import Column, Integer, String, create_engine, func
+from sqlalchemy import Column, Integer, String, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
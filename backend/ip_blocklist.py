@@ -0,0 +1,98 @@
+import ipaddress
+import json
+import os
+import threading
+import time
+
+BLOCKLIST_FILE = "blocked_ips.json"
+RELOAD_CHECK_INTERVAL = 5  # seconds between two checks of the file's modification time
+
+
+class PrefixTrie:
+    """Binary trie of network prefixes. A lookup walks at most one node per address bit."""
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, network) -> None:
+        node = self._root
+        bits = int(network.network_address)
+        for i in range(network.prefixlen):
+            if node.get("blocked"):
+                # already covered by a shorter prefix
+                return
+            node = node.setdefault((bits >> (network.max_prefixlen - 1 - i)) & 1, {})
+        node["blocked"] = True
+
+    def contains(self, address) -> bool:
+        node = self._root
+        bits = int(address)
+        for i in range(address.max_prefixlen):
+            if node.get("blocked"):
+                return True
+            node = node.get((bits >> (address.max_prefixlen - 1 - i)) & 1)
+            if node is None:
+                return False
+        return node.get("blocked", False)
+
+
+class IPBlocklist:
+    """
+    Blocked IP addresses and CIDR ranges (e.g. "203.0.113.7", "198.51.100.0/24", "2001:db8::/32"),
+    read from a JSON list. The file is reloaded when it changes; a reload builds new tries and swaps
+    them in at once, so concurrent lookups see either the old or the new list.
+    """
+
+    def __init__(self, path: str = BLOCKLIST_FILE, check_interval: float = RELOAD_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._reload_lock = threading.Lock()
+        self._mtime = None
+        self._next_check = 0.0
+        # (IPv4 trie, IPv6 trie, number of entries)
+        self._tries = (PrefixTrie(), PrefixTrie(), 0)
+        self.reload()
+
+    def reload(self) -> int:
+        """Read the file again and return the number of entries. Invalid entries are skipped."""
+        with self._reload_lock:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, "r") as infile:
+                entries = json.load(infile)
+            tries = {4: PrefixTrie(), 6: PrefixTrie()}
+            for entry in entries:
+                try:
+                    network = ipaddress.ip_network(entry, strict=False)
+                except ValueError:
+                    print(f"Skipping invalid blocklist entry: {entry}")
+                    continue
+                tries[network.version].add(network)
+            self._tries = (tries[4], tries[6], len(entries))
+            self._mtime = mtime
+            return len(entries)
+
+    def _reload_if_changed(self) -> None:
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        try:
+            if os.path.getmtime(self.path) != self._mtime:
+                self.reload()
+        except (OSError, ValueError) as e:
+            # keep the current list if the file is missing or being written
+            print(f"Could not reload blocklist: {e}")
+
+    def is_blocked(self, ip: str) -> bool:
+        self._reload_if_changed()
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        ipv4, ipv6, _ = self._tries
+        return (ipv4 if address.version == 4 else ipv6).contains(address)
+
+    def __len__(self) -> int:
+        return self._tries[2]
@@ -0,0 +1,52 @@
+"""
+Move the images and deleted files from the flat layout ({folder}/{file}) to the sharded layout
+({folder}/{shard}/{file}, see image_processing.image_path). The app finds files in both layouts, so
+this can run while it is serving, and it can be interrupted and restarted at any time: each file is
+moved with a single rename and only files still in the flat layout are processed.
+
+Only run this after switching on image_processing.SHARD_IMAGES, since app versions that load images
+by their static URL cannot find migrated files.
+
+Usage: python migrate_images.py [--dry-run]
+"""
+import argparse
+import os
+
+from image_processing import SHARD_IMAGES, image_path
+
+PATH_IMAGES = os.path.join("..", "..", "images", "freestuff", "images")
+PATH_DELETED = os.path.join("..", "..", "images", "freestuff", "deleted")
+PROGRESS_INTERVAL = 10_000  # files
+
+
+def migrate_folder(folder: str, dry_run: bool = False) -> int:
+    """Move all files at the top level of folder into their shard. Returns the number of files moved."""
+    nr_moved = 0
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            dst_path = image_path(folder, entry.name, sharded=True)
+            if not dry_run:
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                try:
+                    # atomic within the file system, readers see the file in one of the two places
+                    os.rename(entry.path, dst_path)
+                except FileNotFoundError:
+                    # moved or deleted concurrently, e.g. by delete_post
+                    continue
+            nr_moved += 1
+            if nr_moved % PROGRESS_INTERVAL == 0:
+                print(f"{folder}: {nr_moved} files moved")
+    return nr_moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true", help="only count the files to move")
+    args = parser.parse_args()
+    if not SHARD_IMAGES and not args.dry_run:
+        parser.exit(1, "image_processing.SHARD_IMAGES is off, older app versions still need the flat layout\n")
+    for folder in [PATH_IMAGES, PATH_DELETED]:
+        nr_moved = migrate_folder(folder, dry_run=args.dry_run)
+        print(f"{folder}: {nr_moved} files {'to move' if args.dry_run else 'moved'}")
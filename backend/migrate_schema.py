@@ -0,0 +1,184 @@
+"""
+Create and verify the tables and indexes that the read and maintenance queries rely on.
+Comments stored in the old JSON files are imported into the comments table once.
+
+Usage:
+    python migrate_schema.py           # migrate, then verify indexes and query plans
+    python migrate_schema.py --check   # only verify
+"""
+import argparse
+import json
+from datetime import date, datetime
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
+from comments import Comments, read_comment_files
+from image_store import ImageBlobs, PostImages, TelegramMedia
+from read_write_postings import DeletedPosts, Postings, Session, filter_postings_query
+
+# time_posted used to be stored as text, which makes the time filter compare strings
+TIMESTAMP_COLUMNS = [("posts", "time_posted"), ("deleted_posts", "time_posted"), ("deleted_posts", "deleted_at")]
+# columns added after the tables were created: (table, column, type)
+NEW_COLUMNS = [
+    ("posts", "fingerprint", "text"),
+    ("deleted_posts", "fingerprint", "text"),
+    ("posts", "created_at", "timestamp"),
+    ("deleted_posts", "created_at", "timestamp"),
+]
+
+# index name -> DDL
+INDEXES = {
+    # bounding box filter of all map endpoints
+    "posts_geometry_gist": "CREATE INDEX IF NOT EXISTS posts_geometry_gist ON posts USING GIST (geometry)",
+    # single category filter, ordered by time
+    "posts_category_time_posted": (
+        "CREATE INDEX IF NOT EXISTS posts_category_time_posted ON posts (category, time_posted DESC)"
+    ),
+    # keyset pagination of /postings.json
+    "posts_time_posted_id": "CREATE INDEX IF NOT EXISTS posts_time_posted_id ON posts (time_posted DESC, id DESC)",
+    # delete_expired_posts
+    "posts_expiration_temporary": (
+        "CREATE INDEX IF NOT EXISTS posts_expiration_temporary ON posts (expiration_date) WHERE status = 'temporary'"
+    ),
+    # postings inserted shortly before the previous call of /postings/changes
+    "posts_created_at": "CREATE INDEX IF NOT EXISTS posts_created_at ON posts (created_at)",
+    # removals in /postings/changes
+    "deleted_posts_deleted_at": "CREATE INDEX IF NOT EXISTS deleted_posts_deleted_at ON deleted_posts (deleted_at)",
+    # deduplication of imports (insert_posting upserts on it)
+    "posts_fingerprint": "CREATE UNIQUE INDEX IF NOT EXISTS posts_fingerprint ON posts (fingerprint)",
+    "deleted_posts_fingerprint": (
+        "CREATE INDEX IF NOT EXISTS deleted_posts_fingerprint ON deleted_posts (fingerprint)"
+    ),
+    # comments of a post
+    "comments_post_id_created_at": (
+        "CREATE INDEX IF NOT EXISTS comments_post_id_created_at ON comments (post_id, created_at)"
+    ),
+    # comments of an IP address
+    "comments_ip": "CREATE INDEX IF NOT EXISTS comments_ip ON comments (ip)",
+}
+
+DEFAULT_FILTERS = {
+    "nelat": None,
+    "nelng": None,
+    "swlat": None,
+    "swlng": None,
+    "show_goods": True,
+    "show_food": True,
+    "goods_subcategory": "All",
+    "food_subcategory": "All",
+    "time_posted_max_days": 20,
+    "show_permanent": True,
+    "cursor": None,
+}
+
+
+def migrate(session) -> None:
+    for table, column in TIMESTAMP_COLUMNS:
+        data_type = session.execute(
+            text("SELECT data_type FROM information_schema.columns WHERE table_name = :t AND column_name = :c"),
+            {"t": table, "c": column},
+        ).scalar()
+        if data_type == "text" or data_type == "character varying":
+            print(f"Converting {table}.{column} from {data_type} to timestamp")
+            session.execute(
+                text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE timestamp USING {column}::timestamp")
+            )
+    for table, column, data_type in NEW_COLUMNS:
+        session.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {data_type}"))
+    for table in [Comments, ImageBlobs, PostImages, TelegramMedia]:
+        table.__table__.create(session.connection(), checkfirst=True)
+    for name, ddl in INDEXES.items():
+        print(f"Creating index {name}")
+        session.execute(text(ddl))
+    import_comments(session)
+    session.commit()
+
+
+def import_comments(session) -> None:
+    """Import the comments from the JSON files if the comments table is still empty."""
+    if session.query(Comments.id).first() is not None:
+        return
+    rows = read_comment_files()
+    print(f"Importing {len(rows)} comments")
+    session.bulk_insert_mappings(
+        Comments,
+        [
+            {"post_id": post_id, "ip": ip, "comment": comment, "created_at": created_at}
+            for post_id, ip, comment, created_at in rows
+        ],
+    )
+
+
+def check_indexes(session) -> list:
+    """Return the names of the missing indexes."""
+    existing = {row[0] for row in session.execute(text("SELECT indexname FROM pg_indexes"))}
+    return [name for name in INDEXES if name not in existing]
+
+
+def endpoint_queries(session) -> dict:
+    """The query shapes of the endpoints. GeoJSON, tile and cluster queries wrap filter_postings_query."""
+    bbox = {"nelat": 47.43, "nelng": 8.63, "swlat": 47.32, "swlng": 8.45}
+    return {
+        "postings: bbox": filter_postings_query(session.query(Postings), {**DEFAULT_FILTERS, **bbox}),
+        "postings: single category": filter_postings_query(
+            session.query(Postings), {**DEFAULT_FILTERS, "show_food": False}
+        ),
+        "postings: next page": filter_postings_query(
+            session.query(Postings), {**DEFAULT_FILTERS, "cursor": ("2025-01-01 00:00:00", 1)}
+        ),
+        "changes: removals": session.query(DeletedPosts.id).filter(DeletedPosts.deleted_at > datetime(2025, 1, 1)),
+        "changes: recent inserts": session.query(Postings.id).filter(Postings.created_at > datetime(2025, 1, 1)),
+        "delete_expired_posts": session.query(Postings).filter(
+            Postings.status == "temporary", Postings.expiration_date < date.today()
+        ),
+        "insert_posting: duplicates": session.query(Postings.id).filter(Postings.fingerprint.in_(["telegram:1:1"])),
+        "comments: by post": session.query(Comments).filter(Comments.post_id == 1).order_by(Comments.created_at),
+        "comments: by ip": session.query(Comments).filter(Comments.ip == "127.0.0.1"),
+    }
+
+
+def explain_uses_index(session, query) -> bool:
+    compiled = query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={"render_postcompile": True})
+    cursor = session.connection().connection.cursor()
+    cursor.execute("EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    def scan_types(node):
+        yield node["Node Type"]
+        for child in node.get("Plans", []):
+            yield from scan_types(child)
+
+    scans = set(scan_types(plan[0]["Plan"]))
+    return "Seq Scan" not in scans and any("Index" in scan for scan in scans)
+
+
+def check_query_plans(session) -> list:
+    """Return the names of the endpoint queries that cannot use an index."""
+    # small tables are always scanned sequentially, so only ask whether an index scan is possible
+    session.execute(text("SET LOCAL enable_seqscan = off"))
+    try:
+        return [name for name, query in endpoint_queries(session).items() if not explain_uses_index(session, query)]
+    finally:
+        session.rollback()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check", action="store_true", help="only verify, do not migrate")
+    args = parser.parse_args()
+
+    session = Session()
+    try:
+        if not args.check:
+            migrate(session)
+        missing = check_indexes(session)
+        print("Missing indexes:", missing if missing else "none")
+        seq_scans = check_query_plans(session)
+        print("Queries without index scan:", seq_scans if seq_scans else "none")
+        if missing or seq_scans:
+            raise SystemExit(1)
+    finally:
+        session.close()
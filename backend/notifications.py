@@ -0,0 +1,169 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+SLACK_CHANNEL = "#freestuff"
+SLACK_USERNAME = "PennyMe"
+# if set, notifications are appended to this file instead of being posted to Slack
+NOTIFICATION_FILE = os.environ.get("NOTIFICATION_FILE")
+
+MIN_SEND_INTERVAL = 1.0  # seconds between two messages (Slack allows about one per second)
+MAX_MESSAGE_LENGTH = 3000  # queued messages are merged up to this length
+MAX_RETRIES = 4
+RETRY_BACKOFF = 2.0  # seconds, doubled after every failed attempt
+DIGEST_INTERVAL = 3 * 60 * 60  # seconds between two digests
+MAX_QUEUED = 1000
+
+
+class SlackSink:
+    """Posts messages to a Slack channel."""
+
+    def __init__(self, token: str, channel: str = SLACK_CHANNEL, username: str = SLACK_USERNAME):
+        from slack import WebClient
+
+        self.client = WebClient(token=token)
+        self.channel = channel
+        self.username = username
+
+    def send(self, message: str) -> None:
+        self.client.chat_postMessage(channel=self.channel, text=message, username=self.username)
+
+
+class FileSink:
+    """Appends messages to a local file, e.g. for development."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def send(self, message: str) -> None:
+        with open(self.path, "a") as outfile:
+            outfile.write(f"[{datetime.now()}] {message}\n")
+
+
+class StubSink:
+    """Keeps messages in memory, for tests. The first `failures` sends raise an error."""
+
+    def __init__(self, failures: int = 0):
+        self.messages = []
+        self.failures = failures
+        self.attempts = 0
+
+    def send(self, message: str) -> None:
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise ConnectionError(f"Send attempt {self.attempts} failed")
+        self.messages.append(message)
+
+
+class NotificationDispatcher:
+    """
+    Sends notifications from a background thread, so that callers never wait for (or fail because of)
+    the sink. Queued messages are merged into one message, sends are rate limited and retried with
+    exponential backoff. Digest messages are collected and sent together every `digest_interval` seconds.
+    """
+
+    def __init__(self, sink, digest_interval: float = DIGEST_INTERVAL, min_send_interval: float = MIN_SEND_INTERVAL):
+        self.sink = sink
+        self.digest_interval = digest_interval
+        self.min_send_interval = min_send_interval
+        self._queue = queue.Queue(maxsize=MAX_QUEUED)
+        self._digest = []
+        self._next_digest = time.monotonic() + digest_interval
+        self._last_send = 0.0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def notify(self, message: str, digest: bool = False) -> None:
+        """Queue a message without blocking. If digest, it is only sent with the next digest."""
+        try:
+            self._queue.put_nowait((message, digest))
+        except queue.Full:
+            print(f"Notification queue full, dropping: {message}")
+
+    def close(self, timeout: float = 10) -> None:
+        """Send everything that is queued (including the digest) and stop the thread."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            timeout = max(self._next_digest - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            closing = item is None
+
+            # drain what is queued, so that bursts result in a single message
+            messages = []
+            while item:
+                message, digest = item
+                (self._digest if digest else messages).append(message)
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                closing = closing or item is None
+
+            if time.monotonic() >= self._next_digest or closing:
+                if self._digest:
+                    messages.append(f"Digest ({len(self._digest)} messages):\n" + "\n".join(self._digest))
+                    self._digest = []
+                self._next_digest = time.monotonic() + self.digest_interval
+
+            for batch in merge_messages(messages):
+                self._send(batch)
+            if closing:
+                return
+
+    def _send(self, message: str) -> None:
+        wait = self._last_send + self.min_send_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        backoff = RETRY_BACKOFF
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                self.sink.send(message)
+                break
+            except Exception as e:
+                if attempt == MAX_RETRIES:
+                    print(f"Failed to send notification after {MAX_RETRIES + 1} attempts: {e}")
+                    break
+                time.sleep(backoff)
+                backoff *= 2
+        self._last_send = time.monotonic()
+
+
+def merge_messages(messages: list, max_length: int = MAX_MESSAGE_LENGTH) -> list:
+    """Join messages with newlines into as few messages as possible that are at most max_length long."""
+    batches = []
+    for message in messages:
+        message = message[:max_length]
+        if batches and len(batches[-1]) + 1 + len(message) <= max_length:
+            batches[-1] += "\n" + message
+        else:
+            batches.append(message)
+    return batches
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher() -> NotificationDispatcher:
+    """The dispatcher of this process, sending to Slack or to NOTIFICATION_FILE if that is set."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            sink = FileSink(NOTIFICATION_FILE) if NOTIFICATION_FILE else SlackSink(os.environ["SLACK_TOKEN"])
+            _dispatcher = NotificationDispatcher(sink)
+            atexit.register(_dispatcher.close)
+        return _dispatcher
+
+
+def post_to_slack(message: str, digest: bool = False) -> None:
+    """Post message to Slack channel (asynchronously, see NotificationDispatcher)."""
+    get_dispatcher().notify(message, digest=digest)
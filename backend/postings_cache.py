@@ -0,0 +1,241 @@
+import hashlib
+import json
+import math
+import select
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import text
+
+# Postgres channel on which writers announce changes to the posts table
+CHANGE_CHANNEL = "posts_changed"
+# bounding boxes are snapped outwards to a grid of tiles of this size (in degrees)
+TILE_SIZE_DEG = 0.02
+CACHE_MAX_ENTRIES = 512
+CACHE_TTL = 60  # seconds, upper bound on staleness if a notification gets lost
+LISTENER_RECONNECT_DELAY = 5  # seconds
+
+
+def notify_posting_change(session, op: str, post_id: int, lon: float, lat: float, expiration_date=None) -> None:
+    """
+    Announce a write to the posts table. Postgres delivers the notification when the
+    transaction of `session` commits, so listeners never see rolled back writes.
+
+    Args:
+        session: The session in which the post is inserted or deleted.
+        op: "insert" or "delete".
+        post_id: ID of the affected post.
+        lon: Longitude of the affected post.
+        lat: Latitude of the affected post.
+        expiration_date: Expiration date (datetime.date) of an inserted temporary post.
+    """
+    change = {"op": op, "id": post_id, "lon": lon, "lat": lat}
+    if expiration_date is not None:
+        change["expiration_date"] = expiration_date.isoformat()
+    session.execute(
+        text("SELECT pg_notify(:channel, :payload)"), {"channel": CHANGE_CHANNEL, "payload": json.dumps(change)}
+    )
+
+
+def notify_posting_changes(session, changes: list) -> None:
+    """Like notify_posting_change for many changes (dicts with the keys of its payload) in one statement."""
+    if not changes:
+        return
+    session.execute(
+        text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload"),
+        {"channel": CHANGE_CHANNEL, "payloads": [json.dumps(change) for change in changes]},
+    )
+
+
+def lonlat_to_tile(lon: float, lat: float) -> tuple:
+    return math.floor(lon / TILE_SIZE_DEG), math.floor(lat / TILE_SIZE_DEG)
+
+
+def snap_filters(filters: dict):
+    """
+    Snap the bounding box of the filters outwards to the tile grid.
+
+    Returns:
+        The filters with the snapped bounding box and the covered tile range
+        (min_x, min_y, max_x, max_y), or None if no bounding box is given.
+    """
+    if None in (filters["nelat"], filters["nelng"], filters["swlat"], filters["swlng"]):
+        return filters, None
+    min_x, min_y = lonlat_to_tile(filters["swlng"], filters["swlat"])
+    max_x = math.ceil(filters["nelng"] / TILE_SIZE_DEG) - 1
+    max_y = math.ceil(filters["nelat"] / TILE_SIZE_DEG) - 1
+    snapped = dict(filters)
+    snapped["swlng"] = round(min_x * TILE_SIZE_DEG, 6)
+    snapped["swlat"] = round(min_y * TILE_SIZE_DEG, 6)
+    snapped["nelng"] = round((max_x + 1) * TILE_SIZE_DEG, 6)
+    snapped["nelat"] = round((max_y + 1) * TILE_SIZE_DEG, 6)
+    return snapped, (min_x, min_y, max_x, max_y)
+
+
+class PostingsCache:
+    """
+    In-process LRU cache (with TTL) for filtered postings. Keys are the bounding box (tile-snapped
+    where the caller can crop the result) plus the filter arguments, and an entry is dropped as
+    soon as a post is inserted or deleted in one of the tiles covered by its bounding box.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (expiry time, tile range, cached value)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped on every invalidation, so that results loaded concurrently to a write are not stored
+        self._generation = 0
+
+    def get_or_load(self, filters: dict, loader, crop=None):
+        """
+        Return the cached result for the filters or compute it with `loader`.
+
+        Args:
+            filters: Filters as returned by read_write_postings.parse_filter_args.
+            loader: Function that is called with the filters on a cache miss.
+            crop: Function (value, filters) that restricts a result loaded for the tile-snapped
+                bounding box to the requested one, or returns None if that is not possible
+                (e.g. the result was cut off at the row limit). If given, results are shared
+                between all viewports that snap to the same tiles. Otherwise the result is
+                cached under the exact bounding box, so that it never differs from `loader(filters)`.
+        """
+        snapped, tile_range = snap_filters(filters)
+        if crop is not None:
+            value = self._get_or_load(snapped, tile_range, loader)
+            cropped = crop(value, filters)
+            if cropped is not None:
+                return cropped
+        return self._get_or_load(filters, tile_range, loader)
+
+    def _get_or_load(self, filters: dict, tile_range, loader):
+        key = tuple(sorted(filters.items()))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[2]
+            generation = self._generation
+
+        value = loader(filters)
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, tile_range, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate_point(self, lon: float, lat: float) -> None:
+        """Drop all entries whose tiles contain the given location."""
+        tile_x, tile_y = lonlat_to_tile(lon, lat)
+        with self._lock:
+            self._generation += 1
+            stale_keys = [
+                key
+                for key, (_, tile_range, _) in self._entries.items()
+                if tile_range is None
+                or (tile_range[0] <= tile_x <= tile_range[2] and tile_range[1] <= tile_y <= tile_range[3])
+            ]
+            for key in stale_keys:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def handle_change(self, change: dict) -> None:
+        """Apply a change notification sent by notify_posting_change."""
+        self.invalidate_point(change["lon"], change["lat"])
+
+
+class DataVersion:
+    """
+    Version of the posts table as seen by this process, bumped on every change notification.
+    A new epoch starts whenever the listener (re)connects, since changes may have been missed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._epoch = None
+        self._counter = 0
+
+    def current(self):
+        """Return the current version, or None while no listener is connected."""
+        with self._lock:
+            if self._epoch is None:
+                return None
+            return f"{self._epoch}-{self._counter}"
+
+    def etag(self, *parts):
+        """
+        Derive an ETag from the current version and the given (normalized) request arguments,
+        or None while the version is unknown.
+        """
+        version = self.current()
+        if version is None:
+            return None
+        return hashlib.sha1(repr((version,) + parts).encode()).hexdigest()
+
+    def handle_change(self, change: dict) -> None:
+        with self._lock:
+            self._counter += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch = uuid.uuid4().hex[:8]
+            self._counter = 0
+
+    def on_disconnect(self) -> None:
+        """Changes are missed from now on, so the version is unknown until the listener reconnects."""
+        with self._lock:
+            self._epoch = None
+
+
+def listen_for_changes(db_login: dict, handlers: list) -> None:
+    """
+    Block forever and pass every change notification on the posts table to the handlers.
+    The handlers are cleared on (re)connect since notifications may have been missed, and
+    handlers with an `on_disconnect` method are told when the connection is lost.
+    """
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**db_login)
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CHANGE_CHANNEL};")
+            for handler in handlers:
+                handler.clear()
+
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    change = json.loads(conn.notifies.pop(0).payload)
+                    for handler in handlers:
+                        handler.handle_change(change)
+        except Exception as e:
+            print(f"Change listener disconnected: {e}")
+            for handler in handlers:
+                if hasattr(handler, "on_disconnect"):
+                    handler.on_disconnect()
+            if conn is not None:
+                conn.close()
+            time.sleep(LISTENER_RECONNECT_DELAY)
+
+
+def start_change_listener(db_login: dict, handlers: list) -> threading.Thread:
+    """Run listen_for_changes in a daemon thread."""
+    thread = threading.Thread(target=listen_for_changes, args=(db_login, handlers), daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,113 @@
+import math
+import threading
+import time
+import zlib
+
+# Flask endpoint -> (tokens per second, burst size), applied separately per IP address and per user_id
+RATE_LIMITS = {
+    "create_posting": (1 / 60, 5),
+    "create_postings": (1 / 60, 5),
+    "add_comment": (1 / 10, 10),
+    "delete_post": (1 / 10, 10),
+}
+NR_STRIPES = 16
+EVICTION_INTERVAL = 60  # seconds between two sweeps of a stripe for idle buckets
+
+
+class TokenBucketLimiter:
+    """
+    Token buckets for many keys. Each bucket refills at `rate` tokens per second up to `burst`.
+    The table is split into stripes with their own lock, and buckets that have been refilled
+    completely are dropped, since a full bucket is the same as a new one.
+    """
+
+    def __init__(self, rate: float, burst: float, nr_stripes: int = NR_STRIPES):
+        self.rate = rate
+        self.burst = burst
+        # per stripe: lock, key -> (tokens, time of last update), time of last sweep
+        self._locks = [threading.Lock() for _ in range(nr_stripes)]
+        self._buckets = [{} for _ in range(nr_stripes)]
+        self._last_sweep = [time.monotonic()] * nr_stripes
+
+    def acquire(self, *keys: str) -> float:
+        """
+        Take one token from the bucket of each key, but only if all of them have one.
+        Returns 0 on success, otherwise the seconds until every bucket has a token.
+        """
+        stripes = sorted({zlib.crc32(key.encode()) % len(self._locks) for key in keys})
+        now = time.monotonic()
+        # always locked in the same order, so that concurrent calls cannot deadlock
+        for stripe in stripes:
+            self._locks[stripe].acquire()
+        try:
+            for stripe in stripes:
+                if now - self._last_sweep[stripe] > EVICTION_INTERVAL:
+                    self._evict_idle(self._buckets[stripe], now)
+                    self._last_sweep[stripe] = now
+
+            refilled = {}
+            for key in keys:
+                buckets = self._buckets[zlib.crc32(key.encode()) % len(self._locks)]
+                tokens, last = buckets.get(key, (self.burst, now))
+                refilled[key] = min(self.burst, tokens + (now - last) * self.rate)
+            wait = max((1 - tokens) / self.rate for tokens in refilled.values())
+            for key, tokens in refilled.items():
+                buckets = self._buckets[zlib.crc32(key.encode()) % len(self._locks)]
+                buckets[key] = (tokens - 1 if wait <= 0 else tokens, now)
+            return max(wait, 0.0)
+        finally:
+            for stripe in stripes:
+                self._locks[stripe].release()
+
+    def wait(self, key: str) -> float:
+        """Seconds until the bucket of `key` has a token, without taking one."""
+        stripe = zlib.crc32(key.encode()) % len(self._locks)
+        now = time.monotonic()
+        with self._locks[stripe]:
+            tokens, last = self._buckets[stripe].get(key, (self.burst, now))
+        return max((1 - min(self.burst, tokens + (now - last) * self.rate)) / self.rate, 0.0)
+
+    def _evict_idle(self, buckets: dict, now: float) -> None:
+        idle = [key for key, (tokens, last) in buckets.items() if tokens + (now - last) * self.rate >= self.burst]
+        for key in idle:
+            del buckets[key]
+
+    def __len__(self) -> int:
+        return sum(len(buckets) for buckets in self._buckets)
+
+
+class RateLimits:
+    """Rate limits per endpoint, each applied per IP address and per user_id."""
+
+    def __init__(self, limits: dict = RATE_LIMITS):
+        self._limiters = {endpoint: TokenBucketLimiter(rate, burst) for endpoint, (rate, burst) in limits.items()}
+
+    def __contains__(self, endpoint: str) -> bool:
+        return endpoint in self._limiters
+
+    def ip_retry_after(self, endpoint: str, ip: str) -> int:
+        """
+        Check the limit of the endpoint for the IP address alone, without taking a token. This is
+        cheap enough to run before the request body is parsed (which retry_after needs for the user_id).
+
+        Returns:
+            0 if the IP address has a token left, otherwise the seconds after which it may retry.
+        """
+        limiter = self._limiters.get(endpoint)
+        if limiter is None:
+            return 0
+        return math.ceil(limiter.wait(f"ip:{ip}"))
+
+    def retry_after(self, endpoint: str, ip: str, user_id: str = None) -> int:
+        """
+        Take a token of the endpoint for the IP address and the user_id (if given).
+
+        Returns:
+            0 if the request is allowed, otherwise the seconds after which it may be retried.
+        """
+        limiter = self._limiters.get(endpoint)
+        if limiter is None:
+            return 0
+        keys = [f"ip:{ip}", f"user:{user_id}"] if user_id else [f"ip:{ip}"]
+        # a request denied for the user does not use up a token of the IP address, and vice versa
+        return math.ceil(limiter.acquire(*keys))
@@ -1,33 +1,44 @@
+import base64
 import json
-from shapely.geometry import Point
+import math
+from shapely.geometry import Point, mapping
 from datetime import datetime, timedelta
-from PIL import Image, ImageOps
 import numpy as np
 import pandas as pd
 
 # database stuff
-import psycopg2
-from sqlalchemy import Column, Integer, String, create_engine, DateTime, Date
+from sqlalchemy import JSON, Column, Integer, String, Text, DateTime, Date, cast, func
+from sqlalchemy import bindparam, case, false, literal, literal_column, text, tuple_
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert as pg_insert
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from geoalchemy2 import Geometry
-from geoalchemy2.shape import from_shape
+from geoalchemy2.shape import from_shape, to_shape
 from geoalchemy2.functions import ST_MakeEnvelope
 
+from database import PreparedQuery, get_engine
+from postings_cache import notify_posting_change
+
 MAX_RESULTS = 150
+MAX_TILE_FEATURES = 2000
+MVT_LAYER = "postings"
+# clusters are computed on a grid with this many cells per (256px) map tile in each direction
+CLUSTER_CELLS_PER_TILE = 4
+# maximum number of new postings per call of /postings/changes
+CHANGES_LIMIT = 500
+# changes that committed up to this long after they were stamped are still picked up by the next sync
+CHANGES_OVERLAP = 10  # seconds
+# fields of a posting that are stored as text (see posting_values)
+TEXT_FIELDS = ["name", "category", "subcategory", "description", "external_url", "user_id", "expiration_date"]
+# execute the /postings.json query as server-side prepared statement (one per filter_shape)
+USE_PREPARED_STATEMENTS = True
+GEOJSON_STATEMENTS = {}
 
 
 def init_session():
     """Initialize a database session."""
-    DB_FILE = "db_login.json"
-    with open(DB_FILE, "r") as infile:
-        db_login = json.load(infile)
-
-    def get_con():
-        return psycopg2.connect(**db_login)
-
-    engine = create_engine("postgresql+psycopg2://", creator=get_con)
-    return sessionmaker(bind=engine)
+    return sessionmaker(bind=get_engine())
 
 
 Session = init_session()
@@ -49,6 +60,10 @@ class Postings(Base):
     status = Column(String)
     user_id = Column(String)
     geometry = Column(Geometry(geometry_type="POINT", srid=4326))
+    # source of imported postings (see fingerprint.py), unique
+    fingerprint = Column(String)
+    # time of the insert, for /postings/changes (IDs are assigned before the insert commits)
+    created_at = Column(DateTime, default=datetime.now)
 
 
 class DeletedPosts(Base):
@@ -66,59 +81,116 @@ class DeletedPosts(Base):
     status = Column(String)
     user_id = Column(String)
     geometry = Column(Geometry("POINT"))
+    fingerprint = Column(String)
+    created_at = Column(DateTime)
 
     deleted_at = Column(DateTime)
     deletion_mode = Column(String)
 
 
+def posting_values(data: dict, nr_photos: int = 1):
+    """
+    Validate the fields of a posting and convert them to column values.
+
+    Returns:
+        The column values and the location as shapely Point. Raises ValueError for invalid data.
+    """
+    if "geometry" in data:
+        # only set by the importers, clients send lon_coord and lat_coord
+        point = data["geometry"]
+        if not isinstance(point, Point):
+            raise ValueError("Invalid geometry")
+    else:
+        lng = data.get("lon_coord")
+        lat = data.get("lat_coord")
+        if lng is None or lat is None:
+            raise ValueError("Missing coordinates")
+        point = Point(float(lng), float(lat))
+    if not (-180 <= point.x <= 180 and -90 <= point.y <= 90):
+        raise ValueError("Coordinates out of range")
+
+    # the columns are text, anything else would fail the INSERT (of the whole batch in insert_postings)
+    for field in TEXT_FIELDS:
+        value = data.get(field)
+        # missing values of the importers' data frames are NaN
+        if value is not None and not isinstance(value, str) and not (isinstance(value, float) and math.isnan(value)):
+            raise ValueError(f"{field} must be a string")
+
+    # prepare expiration date
+    date_string = data.get("expiration_date") or ""
+    if len(date_string) > 0:
+        expiration_date = datetime.strptime(date_string, "%Y-%m-%d").date()
+        status = "temporary"
+    else:
+        expiration_date = None
+        status = "permanent"
+
+    time_posted = data.get("time_posted", datetime.now())
+    if isinstance(time_posted, str):
+        time_posted = datetime.fromisoformat(time_posted)
+    elif isinstance(time_posted, pd.Timestamp):
+        time_posted = time_posted.to_pydatetime()
+    elif not isinstance(time_posted, datetime):
+        raise ValueError("time_posted must be an ISO formatted string")
+
+    values = {
+        "name": data.get("name"),
+        "time_posted": time_posted,
+        "expiration_date": expiration_date,
+        "photo_id": ",".join(["_" + str(i) for i in range(nr_photos)]),
+        "category": data.get("category", "Goods"),
+        "subcategory": data.get("subcategory", ""),
+        "description": data.get("description", ""),
+        "external_url": data.get("external_url"),
+        "user_id": data.get("user_id", ""),
+        "status": status,
+        "geometry": from_shape(point, srid=4326),
+        "fingerprint": data.get("fingerprint") or None,
+    }
+    return values, point
+
+
+def find_duplicates(session, fingerprints: list) -> dict:
+    """Map the fingerprints that were already inserted (also if deleted since) to the IDs of their posts."""
+    fingerprints = [fingerprint for fingerprint in fingerprints if fingerprint]
+    if not fingerprints:
+        return {}
+    duplicates = {}
+    for table in [DeletedPosts, Postings]:
+        rows = session.query(table.fingerprint, table.id).filter(table.fingerprint.in_(fingerprints))
+        duplicates.update(dict(rows))
+    return duplicates
+
+
 def insert_posting(data, nr_photos: int = 1):
     session = Session()
     try:
-        # Extract and validate fields
-        if "geometry" in data:
-            geom = from_shape(data["geometry"], srid=4326)
-        else:
-            lng = data.get("lon_coord")
-            lat = data.get("lat_coord")
-            if lng is None or lat is None:
-                return {"error": "Missing coordinates"}, 400, -1
-
-            geom = from_shape(Point(lng, lat), srid=4326)
-
-        # prepare expiration date
-        date_string = data.get("expiration_date", "")
-        if len(date_string) > 0:
-            expiration_date = datetime.strptime(date_string, "%Y-%m-%d").date()
-            status = "temporary"
-        else:
-            expiration_date = None
-            status = "permanent"
-
-        if "time_posted" not in data:
-            data["time_posted"] = datetime.now()
-        if isinstance(data["time_posted"], pd.Timestamp):
-            data["time_posted"] = data["time_posted"].to_pydatetime()
-
-        new_posting = Postings(
-            name=data.get("name"),
-            time_posted=data["time_posted"],
-            expiration_date=expiration_date,
-            photo_id=",".join(["_" + str(i) for i in range(nr_photos)]),
-            category=data.get("category", "Goods"),
-            subcategory=data.get("subcategory", ""),
-            description=data.get("description", ""),
-            external_url=data.get("external_url"),
-            user_id=data.get("user_id", ""),
-            status=status,
-            geometry=geom,
-        )
-        session.add(new_posting)
-        session.flush()  # This sends the insert query to the DB but doesn't commit yet
-        # get ID created for the post
-        new_post_id = new_posting.id
-
+        try:
+            values, point = posting_values(data, nr_photos)
+        except ValueError as e:
+            return {"error": str(e)}, 400, -1
+
+        fingerprint = values["fingerprint"]
+        duplicates = find_duplicates(session, [fingerprint])
+        if fingerprint in duplicates:
+            return {"status": "duplicate", "id": duplicates[fingerprint]}, 409, duplicates[fingerprint]
+
+        # the unique index on fingerprint turns a concurrent insert of the same posting into a no-op
+        new_post_id = session.execute(
+            pg_insert(Postings)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=["fingerprint"])
+            .returning(Postings.id)
+        ).scalar()
+        if new_post_id is None:
+            session.rollback()
+            existing_id = find_duplicates(session, [fingerprint])[fingerprint]
+            return {"status": "duplicate", "id": existing_id}, 409, existing_id
+
+        # readers drop their cached results for this location once the insert is committed
+        notify_posting_change(session, "insert", new_post_id, point.x, point.y, values["expiration_date"])
         session.commit()
-        return {"status": "success", "id": new_posting.id}, 200, new_post_id
+        return {"status": "success", "id": new_post_id}, 200, new_post_id
     except Exception as e:
         print("Error:", e)
         session.rollback()
@@ -127,60 +199,235 @@ def insert_posting(data, nr_photos: int = 1):
         session.close()
 
 
-def load_filter_postings(request_args):
-    session = Session()
+def insert_postings(items: list) -> list:
+    """
+    Insert many postings (without photos) with one multi-row INSERT in a single transaction.
+    All items are validated first; invalid items are skipped and reported, as are items whose
+    fingerprint was already inserted.
 
+    Returns:
+        One result per item, either {"id": <new ID>}, {"id": <existing ID>, "duplicate": True} or
+        {"error": <message>}.
+    """
+    results = [None] * len(items)
+    rows, points, positions = [], [], []
+    for i, data in enumerate(items):
+        try:
+            if not isinstance(data, dict):
+                raise ValueError("Posting must be a JSON object")
+            values, point = posting_values(data, nr_photos=0)
+        except (ValueError, TypeError) as e:
+            results[i] = {"error": str(e)}
+            continue
+        rows.append(values)
+        points.append(point)
+        positions.append(i)
+    if not rows:
+        return results
+
+    session = Session()
     try:
-        # Location bounding box
-        nelat = request_args.get("nelat", type=float)
-        nelng = request_args.get("nelng", type=float)
-        swlat = request_args.get("swlat", type=float)
-        swlng = request_args.get("swlng", type=float)
+        duplicates = find_duplicates(session, [values["fingerprint"] for values in rows])
+        new = [i for i, values in enumerate(rows) if values["fingerprint"] not in duplicates]
+        inserted = set()
+        if new:
+            # the order of the RETURNING rows is not guaranteed, so the IDs are drawn from the sequence
+            # beforehand and each row is identified by its ID. Rows that conflict (e.g. the same
+            # fingerprint twice in the batch) are skipped and their IDs left unused.
+            new_ids = session.execute(
+                text("SELECT nextval(pg_get_serial_sequence('posts', 'id')) FROM generate_series(1, :n)"),
+                {"n": len(new)},
+            ).scalars()
+            for i, post_id in zip(new, new_ids):
+                rows[i]["id"] = post_id
+
+            def insert(indices: list) -> set:
+                with session.begin_nested():
+                    return set(
+                        session.execute(
+                            pg_insert(Postings)
+                            .values([rows[i] for i in indices])
+                            .on_conflict_do_nothing(index_elements=["fingerprint"])
+                            .returning(Postings.id)
+                        ).scalars()
+                    )
+
+            try:
+                inserted = insert(new)
+            except DBAPIError:
+                # a row that passed validation was still rejected, which fails the whole statement:
+                # insert row by row to report it and keep the others
+                for i in new:
+                    try:
+                        inserted |= insert([i])
+                    except DBAPIError as e:
+                        results[positions[i]] = {"error": str(e.orig).strip()}
+                new = [i for i in new if results[positions[i]] is None]
+
+        for i in new:
+            post_id = rows[i]["id"]
+            if post_id in inserted:
+                results[positions[i]] = {"id": post_id}
+                notify_posting_change(session, "insert", post_id, points[i].x, points[i].y, rows[i]["expiration_date"])
+        # IDs of the rows that conflicted within the batch or with a concurrent insert
+        conflicts = [rows[i]["fingerprint"] for i in new if results[positions[i]] is None]
+        duplicates.update(find_duplicates(session, conflicts))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    for i, values in enumerate(rows):
+        if results[positions[i]] is None:
+            results[positions[i]] = {"id": duplicates[values["fingerprint"]], "duplicate": True}
+    return results
+
+
+def parse_filter_args(request_args) -> dict:
+    """
+    Parse the bounding box and filter parameters of a postings request.
 
+    Args:
+        request_args: The query arguments of the request (werkzeug MultiDict).
+    """
+    return {
+        # Location bounding box
+        "nelat": request_args.get("nelat", type=float),
+        "nelng": request_args.get("nelng", type=float),
+        "swlat": request_args.get("swlat", type=float),
+        "swlng": request_args.get("swlng", type=float),
         # Filter parameters
-        show_goods = request_args.get("showGoods", default="1") == "1"
-        show_food = request_args.get("showFood", default="1") == "1"
-        goods_subcategory = request_args.get("goodsSubcategory", default="All")
-        food_subcategory = request_args.get("foodSubcategory", default="All")
-        time_posted_max_days = request_args.get("timePostedMax", type=float, default=20)
-        show_permanent = request_args.get("showPermanent", default="1") == "1"
-
-        query = session.query(Postings)
-
-        # Bounding box filter
-        if None not in (nelat, nelng, swlat, swlng):
-            envelope = ST_MakeEnvelope(swlng, swlat, nelng, nelat, 4326)
-            query = query.filter(Postings.geometry.ST_Within(envelope))
-
-        # Category filters
-        category_filters = []
-        if show_goods:
-            category_filters.append("Goods")
-        if show_food:
-            category_filters.append("Food")
-        # Only need to filter if we only want one of the categories
-        if len(category_filters) < 2:
-            query = query.filter(Postings.category.in_(category_filters))
-
-        # Subcategory filters
-        if goods_subcategory != "All" and show_goods:
-            query = query.filter(~((Postings.category == "Goods") & (Postings.subcategory != goods_subcategory)))
-        if food_subcategory != "All" and show_food:
-            query = query.filter(~((Postings.category == "Food") & (Postings.subcategory != food_subcategory)))
-
-        # Permanent filter
-        if not show_permanent:
-            query = query.filter(Postings.status != "permanent")
-
-        # Time filter
-        cutoff_time = datetime.utcnow() - timedelta(days=time_posted_max_days)
-        query = query.filter(Postings.time_posted >= str(cutoff_time))
-
-        # hard limit: 200 posts (ordered by last posted)
-        query = query.order_by(Postings.time_posted.desc())
-        query = query.limit(MAX_RESULTS)
-
-        postings = query.all()
+        "show_goods": request_args.get("showGoods", default="1") == "1",
+        "show_food": request_args.get("showFood", default="1") == "1",
+        "goods_subcategory": request_args.get("goodsSubcategory", default="All"),
+        "food_subcategory": request_args.get("foodSubcategory", default="All"),
+        "time_posted_max_days": request_args.get("timePostedMax", type=float, default=20),
+        "show_permanent": request_args.get("showPermanent", default="1") == "1",
+        # Pagination: (time_posted, id) of the last posting of the previous page
+        "cursor": decode_cursor(request_args.get("cursor")),
+    }
+
+
+def encode_cursor(time_posted: str, post_id: int) -> str:
+    """
+    Opaque pagination token pointing after the posting with the given time and ID.
+    Also used for the sync cursor of /postings/changes (time of the sync and last post ID).
+    """
+    return base64.urlsafe_b64encode(f"{time_posted}|{post_id}".encode()).decode()
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor. Raises ValueError for malformed tokens."""
+    if token is None:
+        return None
+    try:
+        time_posted, post_id = base64.urlsafe_b64decode(token.encode()).decode().rsplit("|", 1)
+        return time_posted, int(post_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor {token}")
+
+
+def filter_shape(filters: dict, limit) -> tuple:
+    """
+    The structure of the query built by filter_postings_query. Queries with the same shape only
+    differ in the values of their named parameters (see filter_params).
+    """
+    return (
+        None not in (filters["nelat"], filters["nelng"], filters["swlat"], filters["swlng"]),
+        filters["show_goods"],
+        filters["show_food"],
+        filters["goods_subcategory"] != "All" and filters["show_goods"],
+        filters["food_subcategory"] != "All" and filters["show_food"],
+        filters["show_permanent"],
+        filters["cursor"] is not None,
+        limit is None,
+    )
+
+
+def filter_params(filters: dict, limit) -> dict:
+    """Values of the named parameters of the query built by filter_postings_query."""
+    category = "Goods" if filters["show_goods"] else "Food"
+    cursor_time, cursor_id = filters["cursor"] if filters["cursor"] is not None else (None, None)
+    return {
+        "swlng": filters["swlng"],
+        "swlat": filters["swlat"],
+        "nelng": filters["nelng"],
+        "nelat": filters["nelat"],
+        "category": category,
+        "goods_subcategory": filters["goods_subcategory"],
+        "food_subcategory": filters["food_subcategory"],
+        "cutoff_time": datetime.utcnow() - timedelta(days=filters["time_posted_max_days"]),
+        "cursor_time": cursor_time,
+        "cursor_id": cursor_id,
+        "limit": limit,
+    }
+
+
+def filter_postings_query(query, filters: dict, limit: int = MAX_RESULTS):
+    """
+    Apply the bounding box, category and time filters to a query on the posts table.
+    All values are named parameters, so that the statement can be prepared per filter_shape.
+
+    Args:
+        query: A query selecting from Postings.
+        filters: Filters as returned by parse_filter_args.
+        limit: Page size. Postings are ordered by (time_posted, id) descending and the page
+            starts after filters["cursor"], so every page is a range scan on that index.
+            If None, the query is neither ordered nor limited (for aggregations).
+    """
+    params = filter_params(filters, limit)
+
+    def param(name, type_=None):
+        return bindparam(name, params[name], type_=type_)
+
+    # Bounding box filter
+    bbox = (filters["nelat"], filters["nelng"], filters["swlat"], filters["swlng"])
+    if None not in bbox:
+        envelope = ST_MakeEnvelope(param("swlng"), param("swlat"), param("nelng"), param("nelat"), 4326)
+        query = query.filter(Postings.geometry.ST_Within(envelope))
+
+    # Category filters
+    # Only need to filter if we only want one of the categories
+    if not filters["show_goods"] and not filters["show_food"]:
+        query = query.filter(false())
+    elif not filters["show_goods"] or not filters["show_food"]:
+        query = query.filter(Postings.category == param("category"))
+
+    # Subcategory filters
+    if filters["goods_subcategory"] != "All" and filters["show_goods"]:
+        query = query.filter(
+            ~((Postings.category == "Goods") & (Postings.subcategory != param("goods_subcategory")))
+        )
+    if filters["food_subcategory"] != "All" and filters["show_food"]:
+        query = query.filter(~((Postings.category == "Food") & (Postings.subcategory != param("food_subcategory"))))
+
+    # Permanent filter
+    if not filters["show_permanent"]:
+        query = query.filter(Postings.status != "permanent")
+
+    # Time filter
+    query = query.filter(Postings.time_posted >= param("cutoff_time", DateTime))
+
+    if limit is None:
+        return query
+
+    # Keyset pagination
+    if filters["cursor"] is not None:
+        cursor = tuple_(param("cursor_time", Postings.time_posted.type), param("cursor_id", Integer))
+        query = query.filter(tuple_(Postings.time_posted, Postings.id) < cursor)
+
+    # hard limit per page (ordered by last posted)
+    query = query.order_by(Postings.time_posted.desc(), Postings.id.desc())
+    return query.limit(param("limit", Integer))
+
+
+def load_filter_postings(filters: dict, limit: int = MAX_RESULTS):
+    """Load the newest postings matching the filters returned by parse_filter_args."""
+    session = Session()
+
+    try:
+        postings = filter_postings_query(session.query(Postings), filters, limit).all()
 
         # print(f"Loaded {len(postings)} posts")
 
@@ -189,20 +436,300 @@ def load_filter_postings(request_args):
         session.close()
 
 
-def process_uploaded_image(img_path: str, basewidth: int = 1000):
+def crop_postings(postings, filters: dict, limit: int = MAX_RESULTS):
     """
-    Optimizes an image for size/quality and re-saves it to the server.
+    Restrict postings loaded for a larger bounding box to the bounding box of the filters.
+
+    Returns:
+        The postings inside the bounding box, or None if the page was full, since then
+        postings of the smaller box may have been cut off in favour of postings outside of it.
+    """
+    if len(postings) >= limit:
+        return None
+    if None in (filters["nelat"], filters["nelng"], filters["swlat"], filters["swlng"]):
+        return postings
+    cropped = []
+    for post in postings:
+        point = to_shape(post.geometry)
+        if in_bbox(point.x, point.y, filters):
+            cropped.append(post)
+    return cropped
+
+
+def crop_feature_collection(body: str, filters: dict, limit: int = MAX_RESULTS):
+    """Same as crop_postings for a serialized FeatureCollection as built by load_filter_postings_geojson."""
+    collection = json.loads(body)
+    features = collection["features"]
+    if len(features) >= limit:
+        return None
+    if None in (filters["nelat"], filters["nelng"], filters["swlat"], filters["swlng"]):
+        return body
+    cropped = [feature for feature in features if in_bbox(*feature["geometry"]["coordinates"], filters)]
+    if len(cropped) == len(features):
+        return body
+    return json.dumps(dict(collection, features=cropped))
+
+
+def in_bbox(lon: float, lat: float, filters: dict) -> bool:
+    # same bounds as ST_Within, which excludes points on the boundary
+    return filters["swlng"] < lon < filters["nelng"] and filters["swlat"] < lat < filters["nelat"]
+
+
+def posting_to_feature(post) -> dict:
+    """Convert a Postings object into a GeoJSON Feature."""
+    expire = post.expiration_date.strftime("%Y-%m-%d") if post.expiration_date else ""
+    geom = to_shape(post.geometry)
+    return {
+        "type": "Feature",
+        "geometry": mapping(geom),
+        "properties": {
+            "id": post.id,
+            "name": post.name,
+            "time_posted": str(post.time_posted).split(".")[0][:-3],
+            "expiration_date": expire,
+            "photo_id": post.photo_id,
+            "category": post.category,
+            "subcategory": post.subcategory,
+            "description": post.description,
+            "external_url": post.external_url,
+            "status": post.status,
+            "user_id": post.user_id,
+        },
+    }
+
+
+def postings_to_feature_collection(postings, limit: int = MAX_RESULTS) -> dict:
+    """
+    Convert Postings objects into a GeoJSON FeatureCollection.
+
+    Args:
+        postings: One page of postings as returned by load_filter_postings.
+        limit: The page size that was used to load them. If the page is full, the
+            collection gets a "next" cursor for loading the following page.
+    """
+    features = [posting_to_feature(post) for post in postings]
+
+    next_cursor = None
+    if len(postings) == limit:
+        next_cursor = encode_cursor(str(postings[-1].time_posted), postings[-1].id)
+    return {"type": "FeatureCollection", "features": features, "next": next_cursor}
+
+
+def load_posting_changes(since, limit: int = CHANGES_LIMIT) -> dict:
+    """
+    Changes of the posts table since a sync cursor, for keeping a local copy up to date.
+
+    Args:
+        since: (time of the previous call, post ID) as decoded from the cursor of the previous
+            call, or None for the initial sync. Postings with a larger ID than the cursor are new;
+            removals are taken from deleted_posts. Since IDs and timestamps are assigned before
+            the writing transaction commits, postings inserted and removed within CHANGES_OVERLAP
+            seconds before the previous call are sent again. Clients apply changes by ID, so this
+            is harmless.
+        limit: Maximum number of new postings. If there are more, "has_more" is set and the
+            client should call again with the returned cursor.
+
+    Returns:
+        FeatureCollection of new postings with the IDs of removed postings and the next cursor.
+    """
+    session = Session()
+    # same clock as created_at and deleted_at
+    synced_at = datetime.now()
+
+    try:
+        if since is None:
+            last_id = 0
+            new_postings = Postings.id > last_id
+            removed = []
+        else:
+            synced_since, last_id = since
+            min_changed_at = literal(synced_since, DateTime) - timedelta(seconds=CHANGES_OVERLAP)
+            new_postings = (Postings.id > last_id) | (Postings.created_at > min_changed_at)
+            removed = session.query(DeletedPosts.id).filter(DeletedPosts.deleted_at > min_changed_at).all()
+
+        postings = session.query(Postings).filter(new_postings).order_by(Postings.id).limit(limit).all()
+        if len(postings) > 0:
+            last_id = max(last_id, postings[-1].id)
+
+        return {
+            "type": "FeatureCollection",
+            "features": [posting_to_feature(post) for post in postings],
+            "removed": [row.id for row in removed],
+            "cursor": encode_cursor(str(synced_at), last_id),
+            "has_more": len(postings) == limit,
+        }
+    finally:
+        session.close()
+
+
+def geojson_statement(session, filters: dict, limit: int):
+    """Statement that lets PostGIS assemble the FeatureCollection of load_filter_postings_geojson."""
+    columns = [
+        Postings.id,
+        Postings.name,
+        Postings.time_posted,
+        Postings.expiration_date,
+        Postings.photo_id,
+        Postings.category,
+        Postings.subcategory,
+        Postings.description,
+        Postings.external_url,
+        Postings.status,
+        Postings.user_id,
+        Postings.geometry,
+    ]
+    rows = filter_postings_query(session.query(*columns), filters, limit).subquery()
+    # same format as post.time_posted.split(".")[0][:-3]
+    time_posted = func.left(func.split_part(cast(rows.c.time_posted, Text), ".", 1), -3)
+    feature = func.json_build_object(
+        "type",
+        "Feature",
+        "geometry",
+        cast(func.ST_AsGeoJSON(rows.c.geometry), JSON),
+        "properties",
+        func.json_build_object(
+            "id",
+            rows.c.id,
+            "name",
+            rows.c.name,
+            "time_posted",
+            time_posted,
+            "expiration_date",
+            func.coalesce(func.to_char(rows.c.expiration_date, "YYYY-MM-DD"), ""),
+            "photo_id",
+            rows.c.photo_id,
+            "category",
+            rows.c.category,
+            "subcategory",
+            rows.c.subcategory,
+            "description",
+            rows.c.description,
+            "external_url",
+            rows.c.external_url,
+            "status",
+            rows.c.status,
+            "user_id",
+            rows.c.user_id,
+        ),
+    )
+    order = (rows.c.time_posted.desc(), rows.c.id.desc())
+    features = func.coalesce(func.json_agg(aggregate_order_by(feature, *order)), literal_column("'[]'::json"))
+    # same token as encode_cursor for the last posting, if the page is full
+    cursor_text = cast(rows.c.time_posted, Text) + "|" + cast(rows.c.id, Text)
+    token = func.translate(func.encode(func.convert_to(cursor_text, "UTF8"), "base64"), "+/\n", "-_")
+    last_token = func.array_agg(aggregate_order_by(token, *order))[func.count(rows.c.id)]
+    page_full = func.count(rows.c.id) == bindparam("limit", limit, type_=Integer)
+    next_cursor = case((page_full, last_token), else_=None)
+    collection = func.json_build_object("type", "FeatureCollection", "features", features, "next", next_cursor)
+    # cast to text so that psycopg2 hands over the string without parsing it
+    return session.query(cast(collection, Text)).select_from(rows).statement
+
+
+def load_filter_postings_geojson(filters: dict, limit: int = MAX_RESULTS) -> str:
+    """
+    Same as load_filter_postings, but PostGIS assembles the GeoJSON FeatureCollection
+    (equal to postings_to_feature_collection) and the serialized string is returned.
+    """
+    session = Session()
+
+    try:
+        if not USE_PREPARED_STATEMENTS:
+            return session.execute(geojson_statement(session, filters, limit)).scalar()
+
+        shape = filter_shape(filters, limit)
+        prepared = GEOJSON_STATEMENTS.get(shape)
+        if prepared is None:
+            prepared = GEOJSON_STATEMENTS.setdefault(shape, PreparedQuery(geojson_statement(session, filters, limit)))
+        return prepared.execute(session, filter_params(filters, limit)).fetchone()[0]
+    finally:
+        session.close()
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple:
+    """Return (west, south, east, north) in degrees of the web mercator tile z/x/y."""
+    n = 2**z
+
+    def lat(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)
+
+
+def load_postings_tile(z: int, x: int, y: int, filters: dict) -> bytes:
+    """
+    Encode the postings in tile z/x/y that match the filters as a Mapbox Vector Tile.
 
     Args:
-        img_path: The path to save the image to.
-        basewidth: width of rescaled image, defaults to 1000. Used to be 400.
-    """
-    img = Image.open(img_path)
-    img = ImageOps.exif_transpose(img)
-    wpercent = basewidth / float(img.size[0])
-    if wpercent > 1:
-        return "Image uploaded successfully, no resize necessary"
-    # resize
-    hsize = int((float(img.size[1]) * float(wpercent)))
-    img = img.resize((basewidth, hsize), Image.Resampling.LANCZOS)
-    img.save(img_path, quality=95)
+        z, x, y: Tile coordinates (web mercator, XYZ scheme).
+        filters: Filters as returned by parse_filter_args, the bounding box is replaced by the tile.
+    """
+    west, south, east, north = tile_bounds(z, x, y)
+    filters = dict(filters, swlng=west, swlat=south, nelng=east, nelat=north, cursor=None)
+
+    session = Session()
+
+    try:
+        mvt_geom = func.ST_AsMVTGeom(
+            func.ST_Transform(Postings.geometry, 3857), func.ST_TileEnvelope(z, x, y), type_=Geometry
+        )
+        columns = [
+            mvt_geom.label("geom"),
+            Postings.id,
+            Postings.name,
+            func.left(func.split_part(cast(Postings.time_posted, Text), ".", 1), -3).label("time_posted"),
+            func.coalesce(func.to_char(Postings.expiration_date, "YYYY-MM-DD"), "").label("expiration_date"),
+            Postings.photo_id,
+            Postings.category,
+            Postings.subcategory,
+            Postings.status,
+        ]
+        rows = filter_postings_query(session.query(*columns), filters, MAX_TILE_FEATURES).subquery("tile")
+        tile = session.query(func.ST_AsMVT(literal_column("tile"), MVT_LAYER, 4096, "geom")).select_from(rows).scalar()
+        return bytes(tile) if tile is not None else b""
+    finally:
+        session.close()
+
+
+def load_postings_clusters(filters: dict, zoom: int) -> dict:
+    """
+    Aggregate the postings matching the filters into clusters on a grid that gets finer with the zoom level.
+
+    Returns:
+        GeoJSON FeatureCollection with one point per non-empty grid cell, located at the centroid of its postings.
+    """
+    cell_size = 360 / 2**zoom / CLUSTER_CELLS_PER_TILE
+    session = Session()
+
+    try:
+        rows = filter_postings_query(session.query(Postings.id, Postings.category, Postings.geometry), filters, None)
+        rows = rows.subquery()
+        count = func.count(rows.c.id)
+        clusters = (
+            session.query(
+                count,
+                func.ST_AsGeoJSON(func.ST_Centroid(func.ST_Collect(rows.c.geometry))),
+                count.filter(rows.c.category == "Goods"),
+                count.filter(rows.c.category == "Food"),
+                func.min(rows.c.id),
+            )
+            .group_by(func.ST_SnapToGrid(rows.c.geometry, cell_size))
+            .all()
+        )
+    finally:
+        session.close()
+
+    features = []
+    for nr_posts, centroid, nr_goods, nr_food, min_id in clusters:
+        feature = {
+            "type": "Feature",
+            "geometry": json.loads(centroid),
+            "properties": {
+                "count": nr_posts,
+                "categories": {"Goods": nr_goods, "Food": nr_food},
+                # single posts can be opened directly
+                "id": min_id if nr_posts == 1 else None,
+            },
+        }
+        features.append(feature)
+    return {"type": "FeatureCollection", "features": features}
+
@@ -1,26 +1,30 @@
 import asyncio
 import json
 import os
-import time
 
 import pandas as pd
 from sqlalchemy.orm import sessionmaker
 from telethon import TelegramClient, events
 
-from read_write_postings import insert_posting
+from fingerprint import telegram_fingerprint
+from read_write_postings import Session, insert_posting
 
 from telegram_utils.data_preprocessing import (
-    IMG_OUT_PATH,
     create_geojson,
     get_last_updated,
-    get_used_ids,
 )
 from telegram_utils.extract_location import get_address, get_postal
-from telegram_utils.utils import merge_rows_postprocessing, optimize_img_file_size
-from app import post_to_slack
-
-SLACK_INTERVAL = 3  # interval how frequently to post to slack in hours
-last_posted_to_slack = time.time() - SLACK_INTERVAL * 60 * 60  # initialize to allow immediate posting on first run
+from telegram_utils.utils import merge_rows_postprocessing
+from image_processing import link_image, process_uploaded_image
+from image_store import (
+    add_post_image,
+    blob_path,
+    content_hash,
+    lookup_telegram_media,
+    remember_telegram_media,
+    static_image_links,
+)
+from notifications import post_to_slack
 
 chat_name_mapping = {
     131336840: "Goods",  # Test chat
@@ -83,6 +87,37 @@ headings = {
 }
 
 
+async def store_img(msg, post_id, idx):
+    """
+    Add the photo of a message to the image store as image `idx` of the post. Photos that were
+    downloaded before (e.g. posted to several chats) are not downloaded again.
+    """
+    media_id = str(msg.photo.id) if msg.photo is not None else None
+    session = Session()
+    try:
+        image_hash = lookup_telegram_media(session, media_id) if media_id else None
+        image_data = None
+        if image_hash is None:
+            image_data = await msg.download_media(file=bytes)
+            if image_data is None:
+                return
+            image_hash = content_hash(image_data)
+        links = static_image_links(post_id, idx)
+        if add_post_image(session, post_id, idx, image_hash):
+            if image_data is None:
+                image_data = await msg.download_media(file=bytes)
+            # create the same size variants as for app uploads
+            process_uploaded_image(image_data, blob_path(image_hash), links)
+        else:
+            for link_path in links:
+                link_image(blob_path(image_hash), link_path)
+        if media_id:
+            remember_telegram_media(session, media_id, image_hash)
+        session.commit()
+    finally:
+        session.close()
+
+
 async def download_img(msg, id_current, client=None):
     """Download potential images from a message."""
     # Assume msg is a Message object you received from an event
@@ -92,10 +127,9 @@ async def download_img(msg, id_current, client=None):
         album_msgs = await client.get_messages(msg.chat_id, filter=None, min_id=0, limit=5)
         album_msgs = [m for m in album_msgs if m.grouped_id == msg.grouped_id]
         for i, m in enumerate(reversed(album_msgs)):  # preserve original order
-            await m.download_media(file=os.path.join(IMG_OUT_PATH, f"{id_current}_{i}.jpg"))
+            await store_img(m, id_current, i)
     else:
-        # thumb =0 was super small, thumb=3 seemed pretty much the original size
-        await msg.download_media(file=os.path.join(IMG_OUT_PATH, f"{id_current}_0.jpg"), thumb=1)
+        await store_img(msg, id_current, 0)
 
 
 def handle_incoming_message(msg, last_msg, chat_nr):
@@ -135,6 +169,9 @@ def handle_incoming_message(msg, last_msg, chat_nr):
         "external_url": chat_url_mapping.get(chat_nr, None),  # No external URL in the messages
         "category": chat_type,
         "time_posted": msg.date,
+        # replays of the history do not insert the message again
+        # get_history passes the chat IDs of its list, which may lack the -100 prefix of msg.chat_id
+        "fingerprint": telegram_fingerprint(msg.chat_id, msg.id),
         "zip": get_postal(msg_text),
         "address": get_address(msg_text),
     }
@@ -212,6 +249,8 @@ async def get_history(api_config, download_images=DOWNLOAD_IMAGES):
                         post_to_slack(
                             f"New telegram post added (source: {chat_info_mapping[msg.chat_id]}): {msg_w_coords.iloc[0]['message']}"
                         )
+                    elif not DEBUGGING and error_code == 409:
+                        print("Already imported as posting with ID:", new_post_id)
                     elif not DEBUGGING:
                         print("Error inserting posting:", jsonify_result)
 
@@ -273,12 +312,13 @@ def get_online(api_config):
                         print("Successfully inserted posting with ID:", new_post_id)
                         await download_img(msg, new_post_id)
                         prev_msg = msg_dict
-                        global last_posted_to_slack
-                        if time.time() - last_posted_to_slack > SLACK_INTERVAL * 60 * 60:
-                            post_to_slack(
-                                f"New telegram post added (source: {chat_info_mapping[msg.chat_id]}): {msg_w_coords.iloc[0]['message'].replace('\n', ' ')[:100]}"
-                            )
-                            last_posted_to_slack = time.time()
+                        # collected into one digest every DIGEST_INTERVAL
+                        post_to_slack(
+                            f"New telegram post added (source: {chat_info_mapping[msg.chat_id]}): {msg_w_coords.iloc[0]['message'].replace('\n', ' ')[:100]}",
+                            digest=True,
+                        )
+                    elif error_code == 409:
+                        print("Already imported as posting with ID:", new_post_id)
                     else:
                         print("Error inserting posting:", jsonify_result)
                 else:
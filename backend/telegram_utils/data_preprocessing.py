@@ -29,9 +29,18 @@ def get_last_updated():
             last_update[category] = pd.to_datetime("2023-10-08 00:00:00+00:00")
 
 
-def get_used_ids():
-    ids_in_use = [int(i.split(".")[0]) for i in os.listdir(IMG_OUT_PATH) if i[0] != "."]
-    return ids_in_use
+def get_max_used_id() -> int:
+    """Highest post ID in use, also by deleted posts whose images are kept (0 if there are none)."""
+    # imported here, so that importing this module neither connects to the database nor needs the backend root
+    from sqlalchemy import func
+
+    from read_write_postings import DeletedPosts, Postings, Session
+
+    session = Session()
+    try:
+        return max(session.query(func.max(table.id)).scalar() or 0 for table in [Postings, DeletedPosts])
+    finally:
+        session.close()
 
 
 def jitter_lonlat(lon, lat, radius_m=20.0, rng=None):
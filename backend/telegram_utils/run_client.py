@@ -10,11 +10,11 @@ from data_preprocessing import (
     IMG_OUT_PATH,
     create_geojson,
     get_last_updated,
-    get_used_ids,
+    get_max_used_id,
 )
 from extract_location import get_address, get_postal
 from to_database import MessageTable, Session, find_max_id
-from utils import merge_rows_postprocessing, optimize_img_file_size
+from utils import merge_rows_postprocessing
 
 chat_name_mapping = {131336840: "Test", 1343503814: "Food", 1001280863188: "Goods"}
 DOWNLOAD_IMAGES = True
@@ -92,10 +92,7 @@ async def get_history(api_config, download_images=DOWNLOAD_IMAGES):
     message_list = []
     # https://stackoverflow.com/questions/44467293/how-can-i-download-the-chat-history-of-a-group-in-telegram
 
-    id_current = 0
-    ids_in_use = get_used_ids()
-    if len(ids_in_use) > 0:
-        id_current = max(ids_in_use)
+    id_current = get_max_used_id()
 
     async with TelegramClient(
         "anon", api_config["api_id"], api_config["api_hash"]
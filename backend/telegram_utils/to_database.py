@@ -1,22 +1,16 @@
-import json
+import os
+import sys
 
 import pandas as pd
-import psycopg2
-from sqlalchemy import create_engine
 from telethon import TelegramClient, events
 
-DB_FILE = "db_login.json"
-with open(DB_FILE, "r") as infile:
-    db_login = json.load(infile)
+# run_client.py only has telegram_utils on the path, the shared engine factory lives in the backend root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from database import get_engine
 
+engine = get_engine()
 
-def get_con():
-    return psycopg2.connect(**db_login)
-
-
-engine = create_engine("postgresql+psycopg2://", creator=get_con)
-
-from sqlalchemy import Column, Integer, String, create_engine, func
+from sqlalchemy import Column, Integer, String, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -1,8 +1,6 @@
 import json
-import os
 
 import pandas as pd
-from PIL import Image, ImageOps
 
 
 def merge_rows_postprocessing(data):
@@ -29,35 +27,6 @@ def merge_rows_postprocessing(data):
     return data
 
 
-def clean_up_images(listed_photo_ids, path_images):
-    used_photo_ids = ", ".join(listed_photo_ids).split(", ")
-    unused_photos = [
-        p for p in os.listdir(path_images) if p.split(".")[0] not in used_photo_ids
-    ]
-    print(
-        "currently listed postings",
-        len(used_photo_ids),
-        "unused_ids",
-        len(unused_photos),
-    )
-    for p in unused_photos:
-        os.remove(os.path.join(path_images, p))
-
-
-def optimize_img_file_size(img_path):
-    # optimize file size
-    img = Image.open(img_path)
-    img = ImageOps.exif_transpose(img)
-    basewidth = 200
-    wpercent = basewidth / float(img.size[0])
-    if wpercent > 1:
-        return "Image uploaded successfully, no resize necessary"
-    # resize
-    hsize = int((float(img.size[1]) * float(wpercent)))
-    img = img.resize((basewidth, hsize), Image.Resampling.LANCZOS)
-    img.save(img_path, quality=95)
-
-
 def get_chat_nr():
     """Helper method to get chat numbers"""
     from telethon.sync import TelegramClient
@@ -0,0 +1,89 @@
+import ipaddress
+import json
+import os
+
+from ip_blocklist import IPBlocklist, PrefixTrie
+
+
+def trie_of(*networks) -> PrefixTrie:
+    trie = PrefixTrie()
+    for network in networks:
+        trie.add(ipaddress.ip_network(network))
+    return trie
+
+
+def write_blocklist(path, entries, mtime=None):
+    with open(path, "w") as outfile:
+        json.dump(entries, outfile)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_cidr_containment():
+    trie = trie_of("198.51.100.0/24", "203.0.113.7/32")
+    assert trie.contains(ipaddress.ip_address("198.51.100.0"))
+    assert trie.contains(ipaddress.ip_address("198.51.100.255"))
+    assert not trie.contains(ipaddress.ip_address("198.51.101.0"))
+    assert trie.contains(ipaddress.ip_address("203.0.113.7"))
+    assert not trie.contains(ipaddress.ip_address("203.0.113.8"))
+
+
+def test_shorter_prefix_added_after_longer():
+    trie = trie_of("10.1.2.3/32", "10.0.0.0/8")
+    assert trie.contains(ipaddress.ip_address("10.1.2.3"))
+    assert trie.contains(ipaddress.ip_address("10.200.0.1"))
+    assert not trie.contains(ipaddress.ip_address("11.0.0.1"))
+
+
+def test_longer_prefix_added_after_shorter():
+    trie = trie_of("10.0.0.0/8", "10.1.2.3/32")
+    assert trie.contains(ipaddress.ip_address("10.200.0.1"))
+
+
+def test_empty_trie_and_block_all():
+    assert not PrefixTrie().contains(ipaddress.ip_address("192.0.2.1"))
+    assert trie_of("0.0.0.0/0").contains(ipaddress.ip_address("192.0.2.1"))
+
+
+def test_ipv6_and_ipv4_mapped(tmp_path):
+    path = tmp_path / "blocked_ips.json"
+    write_blocklist(path, ["203.0.113.0/24", "2001:db8::/32", "not an ip"])
+    blocklist = IPBlocklist(str(path))
+    assert len(blocklist) == 3
+    assert blocklist.is_blocked("2001:db8:1::1")
+    assert not blocklist.is_blocked("2001:db9::1")
+    assert blocklist.is_blocked("::ffff:203.0.113.5")
+    assert not blocklist.is_blocked("::ffff:198.51.100.5")
+    assert not blocklist.is_blocked("invalid")
+
+
+def test_reload_on_mtime_change(tmp_path):
+    path = tmp_path / "blocked_ips.json"
+    write_blocklist(path, ["192.0.2.1"], mtime=1_000_000)
+    blocklist = IPBlocklist(str(path), check_interval=0)
+    assert blocklist.is_blocked("192.0.2.1")
+    assert not blocklist.is_blocked("192.0.2.2")
+
+    write_blocklist(path, ["192.0.2.2"], mtime=1_000_010)
+    assert blocklist.is_blocked("192.0.2.2")
+    assert not blocklist.is_blocked("192.0.2.1")
+
+
+def test_no_reload_within_check_interval(tmp_path):
+    path = tmp_path / "blocked_ips.json"
+    write_blocklist(path, ["192.0.2.1"], mtime=1_000_000)
+    blocklist = IPBlocklist(str(path), check_interval=3600)
+    blocklist.is_blocked("192.0.2.1")
+    write_blocklist(path, ["192.0.2.2"], mtime=1_000_010)
+    assert not blocklist.is_blocked("192.0.2.2")
+    blocklist.reload()
+    assert blocklist.is_blocked("192.0.2.2")
+
+
+def test_keeps_list_if_file_is_invalid(tmp_path):
+    path = tmp_path / "blocked_ips.json"
+    write_blocklist(path, ["192.0.2.1"], mtime=1_000_000)
+    blocklist = IPBlocklist(str(path), check_interval=0)
+    path.write_text("[")
+    os.utime(path, (1_000_010, 1_000_010))
+    assert blocklist.is_blocked("192.0.2.1")
@@ -0,0 +1,93 @@
+import threading
+import time
+
+import notifications
+from notifications import NotificationDispatcher, StubSink, merge_messages
+
+
+class BlockingSink(StubSink):
+    """Blocks in the first send until released, so that further messages pile up in the queue."""
+
+    def __init__(self):
+        super().__init__()
+        self.sending = threading.Event()
+        self.release = threading.Event()
+
+    def send(self, message: str) -> None:
+        self.sending.set()
+        self.release.wait(5)
+        super().send(message)
+
+
+def test_merge_messages():
+    assert merge_messages(["a", "b", "c"], max_length=3) == ["a\nb", "c"]
+    assert merge_messages(["abcdef", "g"], max_length=4) == ["abcd", "g"]
+    assert merge_messages([]) == []
+
+
+def test_burst_is_merged():
+    sink = BlockingSink()
+    dispatcher = NotificationDispatcher(sink, min_send_interval=0)
+    dispatcher.notify("first")
+    assert sink.sending.wait(5)
+    for i in range(3):
+        dispatcher.notify(f"queued {i}")
+    sink.release.set()
+    dispatcher.close()
+    assert sink.messages == ["first", "queued 0\nqueued 1\nqueued 2"]
+
+
+def test_digest_is_sent_with_interval():
+    sink = StubSink()
+    dispatcher = NotificationDispatcher(sink, digest_interval=0.3, min_send_interval=0)
+    dispatcher.notify("digest 1", digest=True)
+    dispatcher.notify("digest 2", digest=True)
+    dispatcher.notify("direct")
+    time.sleep(0.1)
+    assert sink.messages == ["direct"]
+    time.sleep(0.8)
+    assert sink.messages == ["direct", "Digest (2 messages):\ndigest 1\ndigest 2"]
+    dispatcher.close()
+    assert len(sink.messages) == 2
+
+
+def test_digest_is_flushed_on_close():
+    sink = StubSink()
+    dispatcher = NotificationDispatcher(sink, digest_interval=60, min_send_interval=0)
+    dispatcher.notify("digest", digest=True)
+    dispatcher.close()
+    assert sink.messages == ["Digest (1 messages):\ndigest"]
+
+
+def test_send_is_retried(monkeypatch):
+    monkeypatch.setattr(notifications, "RETRY_BACKOFF", 0.01)
+    sink = StubSink(failures=2)
+    dispatcher = NotificationDispatcher(sink, min_send_interval=0)
+    dispatcher.notify("message")
+    dispatcher.close()
+    assert sink.messages == ["message"]
+    assert sink.attempts == 3
+
+
+def test_message_is_dropped_after_max_retries(monkeypatch):
+    monkeypatch.setattr(notifications, "RETRY_BACKOFF", 0.001)
+    sink = StubSink(failures=notifications.MAX_RETRIES + 1)
+    dispatcher = NotificationDispatcher(sink, min_send_interval=0)
+    dispatcher.notify("lost")
+    while sink.attempts < notifications.MAX_RETRIES + 1:
+        time.sleep(0.01)
+    dispatcher.notify("delivered")
+    dispatcher.close()
+    assert sink.messages == ["delivered"]
+
+
+def test_backoff_doubles(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(notifications, "RETRY_BACKOFF", 0.01)
+    monkeypatch.setattr(notifications.time, "sleep", sleeps.append)
+    sink = StubSink(failures=3)
+    dispatcher = NotificationDispatcher(sink, min_send_interval=0)
+    dispatcher.close()
+    dispatcher._send("message")
+    assert sleeps == [0.01, 0.02, 0.04]
+    assert sink.messages == ["message"]
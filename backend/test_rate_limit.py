@@ -0,0 +1,90 @@
+import rate_limit
+from rate_limit import RateLimits, TokenBucketLimiter
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def fake_clock(monkeypatch) -> FakeTime:
+    clock = FakeTime()
+    monkeypatch.setattr(rate_limit, "time", clock)
+    return clock
+
+
+def test_burst_then_refill(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    limiter = TokenBucketLimiter(rate=0.5, burst=3)
+    assert [limiter.acquire("a") for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire("a") == 2
+    clock.now += 1
+    assert limiter.acquire("a") == 1
+    clock.now += 1
+    assert limiter.acquire("a") == 0
+    # other keys have their own bucket
+    assert limiter.acquire("b") == 0
+
+
+def test_refill_is_capped_at_burst(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    limiter = TokenBucketLimiter(rate=1, burst=2)
+    limiter.acquire("a")
+    clock.now += 100
+    assert [limiter.acquire("a") for _ in range(3)] == [0, 0, 1]
+
+
+def test_full_buckets_are_evicted(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    limiter = TokenBucketLimiter(rate=1, burst=2, nr_stripes=1)
+    limiter.acquire("a")
+    limiter.acquire("b")
+    limiter.acquire("b")
+    assert len(limiter) == 2
+    # "a" is full again after one second, "b" after two
+    clock.now += 1.5
+    assert len(limiter) == 2
+    clock.now += rate_limit.EVICTION_INTERVAL
+    limiter.acquire("c")
+    assert len(limiter) == 1
+
+
+def test_denied_key_does_not_spend_other_tokens(monkeypatch):
+    fake_clock(monkeypatch)
+    limiter = TokenBucketLimiter(rate=1, burst=1)
+    assert limiter.acquire("user") == 0
+    assert limiter.acquire("ip", "user") == 1
+    assert limiter.acquire("ip") == 0
+
+
+def test_wait_does_not_take_a_token(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    limiter = TokenBucketLimiter(rate=0.5, burst=1)
+    assert limiter.wait("a") == 0
+    assert limiter.acquire("a") == 0
+    assert limiter.wait("a") == 2
+    clock.now += 1
+    assert limiter.wait("a") == 1
+    assert limiter.acquire("a") == 1
+
+
+def test_rate_limits_per_ip_and_user(monkeypatch):
+    fake_clock(monkeypatch)
+    limits = RateLimits({"create_posting": (1 / 60, 2)})
+    assert "create_posting" in limits
+    assert "get_all_postings" not in limits
+    assert limits.retry_after("get_all_postings", "192.0.2.1") == 0
+
+    assert limits.retry_after("create_posting", "192.0.2.1", "alice") == 0
+    assert limits.retry_after("create_posting", "192.0.2.1", "alice") == 0
+    assert limits.retry_after("create_posting", "192.0.2.1", "alice") == 60
+    # the IP address is limited for other users as well, the user from other addresses
+    assert limits.retry_after("create_posting", "192.0.2.1", "bob") == 60
+    assert limits.retry_after("create_posting", "192.0.2.2", "alice") == 60
+    assert limits.retry_after("create_posting", "192.0.2.2", "bob") == 0
+    assert limits.ip_retry_after("create_posting", "192.0.2.1") == 60
+    assert limits.ip_retry_after("create_posting", "192.0.2.3") == 0
+    assert limits.ip_retry_after("get_all_postings", "192.0.2.1") == 0